@@ -0,0 +1,3 @@
+"""
+Offline benchmarks for popelines. Run with `python -m benchmarks.run`.
+"""
@@ -0,0 +1,202 @@
+"""
+An in-memory stand-in for the BigQuery client, and a local HTTP server
+standing in for both REST APIs and the GCS JSON API's buckets and resumable
+uploads, so that popelines can be timed without touching Google's services.
+"""
+import base64
+import itertools
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+import google_crc32c
+from google.api_core.client_options import ClientOptions
+from google.api_core.exceptions import NotFound
+from google.auth.credentials import AnonymousCredentials
+from google.cloud import bigquery
+from google.cloud import storage
+
+from popelines.writer import wrap_ndjson
+
+job_ids = itertools.count()
+
+
+class FakeJob:
+    def __init__(self, rows=None, schema=None, output_rows=0):
+        self.job_id = f'fake_job_{next(job_ids)}'
+        self.rows = rows or []
+        self.schema = schema or []
+        self.output_rows = output_rows
+        self.errors = None
+        self.error_result = None
+
+    def done(self):
+        return True
+
+    def result(self, page_size=None):
+        return self.rows
+
+
+class FakeBigQueryClient:
+    """
+    Keeps tables as schemas and row counts. Loads read the whole source so
+    that the cost of producing it is counted, but don't parse it.
+    """
+    def __init__(self, project='fake-project'):
+        self.project = project
+        self.tables = {}
+        self.queries = []
+
+    def dataset(self, dataset_id):
+        return bigquery.DatasetReference(self.project, dataset_id)
+
+    def get_table(self, table_ref):
+        if isinstance(table_ref, str):
+            table_ref = bigquery.TableReference.from_string(table_ref, default_project=self.project)
+        if table_ref.table_id not in self.tables:
+            raise NotFound(f'Table {table_ref.table_id} not found')
+        table = bigquery.Table(table_ref, schema=self.tables[table_ref.table_id]['schema'])
+        table._properties['numRows'] = str(self.tables[table_ref.table_id]['rows'])
+        return table
+
+    def list_tables(self, dataset):
+        return [self.get_table(self.dataset(getattr(dataset, 'dataset_id', dataset)).table(name))
+                for name in self.tables]
+
+    def load_table_from_file(self, source_file, table_ref, job_config=None):
+        rows = sum(1 for _ in wrap_ndjson(source_file))
+        return self._load(table_ref, job_config, rows)
+
+    def load_table_from_uri(self, uris, table_ref, job_config=None):
+        return self._load(table_ref, job_config, 0)
+
+    def _load(self, table_ref, job_config, rows):
+        table = self.tables.setdefault(table_ref.table_id, {'schema': [], 'rows': 0})
+        if job_config is not None and job_config.schema:
+            table['schema'] = job_config.schema
+        if job_config is not None and job_config.write_disposition == 'WRITE_TRUNCATE':
+            table['rows'] = 0
+        table['rows'] += rows
+        return FakeJob(output_rows=rows)
+
+    def query(self, query, job_config=None):
+        self.queries.append(query)
+        return FakeJob(rows=[bigquery.table.Row((None,), {'f0_': 0})])
+
+
+def crc32c(data):
+    return base64.b64encode(google_crc32c.Checksum(data).digest()).decode()
+
+
+def fake_storage_client(url, project='fake-project'):
+    """
+    A real storage client talking to a LocalStub at url.
+    """
+    return storage.Client(project=project,
+                          credentials=AnonymousCredentials(),
+                          client_options=ClientOptions(api_endpoint=url))
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """
+    GET /records?page=n&size=m returns m records, with a cursor to the next
+    page until pages run out. Any bucket exists, and resumable uploads are
+    accepted a chunk at a time, with the object's CRC32C in the final reply.
+    """
+    protocol_version = 'HTTP/1.1'
+    # headers and body go out in separate writes; don't let Nagle hold them
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path.startswith('/storage/v1/b/'):
+            bucket = url.path.split('/')[4]
+            return self.reply(200, json.dumps({'name': bucket}).encode())
+        params = {key: int(value[0]) for key, value in parse_qs(url.query).items() if value[0].isdigit()}
+        page = params.get('cursor', 0)
+        size = params.get('size', 100)
+        pages = params.get('pages', 1)
+        body = {
+            'data': [{'id': page * size + n, 'name': f'record {n}', 'value': n * 1.5} for n in range(size)],
+            'next_cursor': page + 1 if page + 1 < pages else None,
+        }
+        self.reply(200, json.dumps(body).encode())
+
+    def do_POST(self):
+        # /upload/storage/v1/b/<bucket>/o?uploadType=resumable|multipart
+        url = urlparse(self.path)
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        bucket = url.path.split('/')[5]
+        upload_id = str(next(job_ids))
+
+        if parse_qs(url.query)['uploadType'][0] == 'multipart':
+            # small files come in one request: JSON metadata, then the data
+            boundary = self.headers['Content-Type'].split('boundary=')[-1].strip('"').encode()
+            metadata_part, data_part = body.split(b'--' + boundary)[1:3]
+            metadata = json.loads(metadata_part.split(b'\r\n\r\n', 1)[1])
+            data = data_part.split(b'\r\n\r\n', 1)[1][:-2]
+            self.server.uploads[upload_id] = {'bucket': bucket, 'name': metadata['name'], 'size': 0,
+                                              'crc32c': google_crc32c.Checksum()}
+            # like GCS, refuse data that doesn't match the checksum sent with it
+            if metadata.get('crc32c') and metadata['crc32c'] != crc32c(data):
+                return self.reply(400, json.dumps({'error': {'code': 400, 'message': 'crc32c mismatch'}}).encode())
+            return self.receive(self.server.uploads[upload_id], data, len(data))
+
+        metadata = json.loads(body or b'{}')
+        self.server.uploads[upload_id] = {'bucket': bucket, 'name': metadata['name'], 'size': 0,
+                                          'crc32c': google_crc32c.Checksum()}
+        location = f'{self.server.url}{url.path}?uploadType=resumable&upload_id={upload_id}'
+        self.reply(200, headers={'Location': location})
+
+    def do_PUT(self):
+        upload = self.server.uploads[parse_qs(urlparse(self.path).query)['upload_id'][0]]
+        chunk = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        total = self.headers['Content-Range'].split('/')[-1]
+        self.receive(upload, chunk, None if total == '*' else int(total))
+
+    def receive(self, upload, chunk, total):
+        upload['size'] += len(chunk)
+        upload['crc32c'].update(chunk)
+        if total is not None and upload['size'] >= total:
+            body = {
+                'bucket': upload['bucket'],
+                'name': upload['name'],
+                'size': str(upload['size']),
+                'crc32c': base64.b64encode(upload['crc32c'].digest()).decode(),
+            }
+            self.reply(200, json.dumps(body).encode())
+        else:
+            self.reply(308, headers={'Range': f"bytes=0-{upload['size'] - 1}"} if upload['size'] else {})
+
+    def do_DELETE(self):
+        self.reply(204)
+
+    def reply(self, status, body=b'', headers=None):
+        self.send_response(status)
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class LocalStub:
+    """
+    Runs StubHandler on a free local port in a background thread.
+    """
+    def __enter__(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+        self.server.uploads = {}
+        self.url = self.server.url = f'http://127.0.0.1:{self.server.server_port}'
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
@@ -0,0 +1,78 @@
+"""
+Synthetic payloads shaped like the API extracts popelines usually handles.
+"""
+import datetime
+import random
+
+from google.cloud.bigquery import SchemaField
+
+
+def wide_record(n, width=200):
+    """
+    A flat record with width columns of mixed types and API-style keys.
+    """
+    record = {}
+    for col in range(width):
+        kind = col % 5
+        key = f'Field {col}.value' if col % 7 == 0 else f'field_{col}'
+        if kind == 0:
+            record[key] = n * col
+        elif kind == 1:
+            record[key] = n * 0.5 + col
+        elif kind == 2:
+            record[key] = f'text {n} {col}'
+        elif kind == 3:
+            record[key] = (col + n) % 2 == 0
+        else:
+            record[key] = None if n % 3 == 0 else '2020-01-01T00:00:00Z'
+    return record
+
+
+def nested_record(n, depth=8, breadth=3):
+    """
+    A record nested depth levels deep, with breadth scalars and a short list
+    of dicts at every level.
+    """
+    record = {f'leaf.{b}': f'{n}-{b}' for b in range(breadth)}
+    record['1st id'] = n
+    for level in range(depth):
+        record = {
+            f'level {level}': record,
+            f'items-{level}': [{'id': i, 'tag': f't{i}'} for i in range(2)],
+            f'count.{level}': level * n,
+        }
+    return record
+
+
+def records(kind, count):
+    make = wide_record if kind == 'wide' else nested_record
+    return (make(n) for n in range(count))
+
+
+def wide_schema(width):
+    return [{'mode': 'NULLABLE', 'name': f'col_{n}', 'type': 'STRING'} for n in range(width)]
+
+
+def nested_schema_fields(depth, breadth=4, repeated_every=2):
+    """
+    SchemaFields for a table with breadth columns at each of depth levels,
+    every repeated_every-th level being a repeated record.
+    """
+    def level(d):
+        fields = [SchemaField(f'Col.{d}.{b}', 'STRING') for b in range(breadth)]
+        if d < depth:
+            mode = 'REPEATED' if d % repeated_every == 0 else 'NULLABLE'
+            fields.append(SchemaField(f'Rec {d}', 'RECORD', mode=mode, fields=level(d + 1)))
+        return tuple(fields)
+    return list(level(0))
+
+
+def days(years):
+    start = datetime.datetime(2000, 1, 1)
+    return start, start + datetime.timedelta(days=365 * years)
+
+
+def shuffled(items, seed=0):
+    items = list(items)
+    random.Random(seed).shuffle(items)
+    return items
@@ -0,0 +1,240 @@
+"""
+Times popelines' own overhead against the fakes in benchmarks.fakes.
+
+    python -m benchmarks.run                       # default sizes
+    python -m benchmarks.run --sizes 1000,10000 --output results.json
+    python -m benchmarks.run --baseline results.json --threshold 1.25
+
+With --baseline, exits non-zero if any benchmark's time per row is more
+than threshold times the baseline's, so it can gate upgrades in CI.
+"""
+import argparse
+import copy
+import datetime
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from popelines import popeline
+from popelines import copy_table
+from popelines.copy_table import build_copy_query
+
+from benchmarks import payloads
+from benchmarks.fakes import FakeBigQueryClient, LocalStub, fake_storage_client
+
+BENCHMARKS = {}
+
+
+def benchmark(name):
+    def register(func):
+        BENCHMARKS[name] = func
+        return func
+    return register
+
+
+def measure(func, repeat):
+    """
+    Returns the best wall time of repeat runs of func, and the peak memory
+    allocated during one more traced run.
+    """
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return best, peak
+
+
+@benchmark('write_to_json[wide]')
+def bench_write_wide(pope, size, ctx):
+    file_name = os.path.join(ctx['directory'], 'wide.json')
+    return lambda: pope.write_to_json(file_name, payloads.records('wide', size))
+
+
+@benchmark('write_to_json[nested,prep_for_BQ]')
+def bench_write_nested(pope, size, ctx):
+    file_name = os.path.join(ctx['directory'], 'nested.json')
+    return lambda: pope.write_to_json(file_name, payloads.records('nested', size), prep_for_BQ=True)
+
+
+@benchmark('write_to_json[wide,gzip]')
+def bench_write_gzip(pope, size, ctx):
+    file_name = os.path.join(ctx['directory'], 'wide.json.gz')
+    return lambda: pope.write_to_json(file_name, payloads.records('wide', size), compress=True)
+
+
+@benchmark('fix_json_keys[nested]')
+def bench_fix_keys(pope, size, ctx):
+    data = list(payloads.records('nested', size))
+    return lambda: pope.fix_json_keys(data, pope.prep_json_for_BQ_callback)
+
+
+@benchmark('fix_json_values[wide]')
+def bench_fix_values(pope, size, ctx):
+    data = list(payloads.records('wide', size))
+    return lambda: pope.fix_json_values(data, lambda value, key: value)
+
+
+@benchmark('generate_bq_schema[wide,file scan]')
+def bench_schema(pope, size, ctx):
+    file_name = os.path.join(ctx['directory'], 'schema.json')
+    pope.write_to_json(file_name, payloads.records('wide', size))
+    pope.file_schemas.pop(file_name)
+    return lambda: pope.generate_bq_schema(file_name)
+
+
+@benchmark('merge_schemas[wide]')
+def bench_merge(pope, size, ctx):
+    # size columns, half of them new
+    old = payloads.wide_schema(size)
+    new = payloads.shuffled(payloads.wide_schema(size + size // 2))
+    return lambda: pope.merge_schemas(copy.deepcopy(old), new)
+
+
+@benchmark('chunk_date_range[days]')
+def bench_chunks(pope, size, ctx):
+    start = datetime.datetime(2000, 1, 1)
+    end = start + datetime.timedelta(days=size)
+    return lambda: list(pope.chunk_date_range(start, end, 7))
+
+
+@benchmark('copy_table SQL[nested]')
+def bench_copy_sql(pope, size, ctx):
+    # size // 10 tables sharing one nested schema
+    schema = payloads.nested_schema_fields(depth=6)
+    callback = lambda key: key.replace('.', '_').replace(' ', '_')
+
+    def run():
+        copy_table.process_struct_type.cache_clear()
+        copy_table._process_struct_data.cache_clear()
+        for n in range(max(1, size // 10)):
+            build_copy_query(f'project.dataset.table_{n}', schema, callback)
+    return run
+
+
+@benchmark('write_to_bq[wide]')
+def bench_write_to_bq(pope, size, ctx):
+    file_name = os.path.join(ctx['directory'], 'load.json')
+    pope.write_to_json(file_name, payloads.records('wide', size))
+    return lambda: pope.write_to_bq('bench_table', file_name)
+
+
+@benchmark('convert_json_to_columnar[wide,parquet]')
+def bench_to_parquet(pope, size, ctx):
+    file_name = os.path.join(ctx['directory'], 'columnar.json')
+    pope.write_to_json(file_name, payloads.records('wide', size))
+    return lambda: pope.convert_json_to_columnar(file_name, format='parquet')
+
+
+@benchmark('convert_json_to_columnar[wide,avro]')
+def bench_to_avro(pope, size, ctx):
+    file_name = os.path.join(ctx['directory'], 'columnar.json')
+    pope.write_to_json(file_name, payloads.records('wide', size))
+    return lambda: pope.convert_json_to_columnar(file_name, format='avro')
+
+
+@benchmark('write_to_gcs[wide]')
+def bench_write_to_gcs(pope, size, ctx):
+    file_name = os.path.join(ctx['directory'], 'upload.json')
+    pope.write_to_json(file_name, payloads.records('wide', size))
+    return lambda: pope.write_to_gcs('bench/upload.json', file_name, bucket_name='bench')
+
+
+@benchmark('call_api_many[local stub]')
+def bench_call_api(pope, size, ctx):
+    calls = [{'url': f"{ctx['stub'].url}/records", 'params': {'size': 10}} for _ in range(max(1, size // 10))]
+    return lambda: pope.call_api_many(calls)
+
+
+@benchmark('api_to_json[local stub]')
+def bench_api_to_json(pope, size, ctx):
+    file_name = os.path.join(ctx['directory'], 'api.json')
+    pages = max(1, size // 100)
+    return lambda: pope.api_to_json(file_name, f"{ctx['stub'].url}/records", records_path='data',
+                                    params={'size': 100, 'pages': pages})
+
+
+def run(sizes, names, repeat):
+    results = []
+    with tempfile.TemporaryDirectory() as directory, LocalStub() as stub:
+        pope = popeline('bench',
+                        directory=directory,
+                        bq_client=FakeBigQueryClient(),
+                        gcs_client=fake_storage_client(stub.url))
+        pope.log.setLevel(logging.WARNING)
+        ctx = {'directory': directory, 'stub': stub}
+
+        for name in names:
+            for size in sizes:
+                func = BENCHMARKS[name](pope, size, ctx)
+                seconds, peak = measure(func, repeat)
+                result = {
+                    'name': name,
+                    'size': size,
+                    'seconds': seconds,
+                    'per_second': size / seconds if seconds else float('inf'),
+                    'peak_bytes': peak,
+                }
+                results.append(result)
+                print(f"{name:40} {size:>9,} {seconds * 1000:>10.1f} ms "
+                      f"{result['per_second']:>14,.0f}/s {peak / 1024 / 1024:>9.1f} MiB")
+    return results
+
+
+def compare(results, baseline, threshold):
+    """
+    Returns the benchmarks that got more than threshold times slower.
+    """
+    before = {(r['name'], r['size']): r for r in baseline}
+    regressions = []
+    for result in results:
+        old = before.get((result['name'], result['size']))
+        if old and result['seconds'] > old['seconds'] * threshold:
+            regressions.append((result, old))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', default='1000,10000', help='comma-separated row counts')
+    parser.add_argument('--only', default='', help='comma-separated substrings of benchmark names to run')
+    parser.add_argument('--repeat', type=int, default=3, help='runs per benchmark; the best is kept')
+    parser.add_argument('--output', help='write results to this JSON file')
+    parser.add_argument('--baseline', help='JSON results to compare against')
+    parser.add_argument('--threshold', type=float, default=1.25, help='allowed slowdown against the baseline')
+    args = parser.parse_args(argv)
+
+    sizes = [int(size) for size in args.sizes.split(',')]
+    filters = [f for f in args.only.split(',') if f]
+    names = [name for name in BENCHMARKS if not filters or any(f in name for f in filters)]
+
+    results = run(sizes, names, args.repeat)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            regressions = compare(results, json.load(f), args.threshold)
+        for result, old in regressions:
+            print(f"REGRESSION {result['name']} at {result['size']:,}: "
+                  f"{old['seconds'] * 1000:.1f} ms -> {result['seconds'] * 1000:.1f} ms")
+        if regressions:
+            return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,6 +1,12 @@
 from popelines.main import popeline
-from pkg_resources import get_distribution
 
 name = 'popelines'
 
-__version__ = get_distribution("popelines").version
\ No newline at end of file
+
+def __getattr__(attr):
+    # read from the installed metadata on first use rather than at import
+    if attr == '__version__':
+        from importlib.metadata import version
+        globals()['__version__'] = version(name)
+        return globals()['__version__']
+    raise AttributeError(f"module {__name__!r} has no attribute {attr!r}")
@@ -0,0 +1,118 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from popelines.lazy import lazy_import
+
+requests = lazy_import('requests')
+urllib3_retry = lazy_import('urllib3.util.retry')
+
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket allowing rate requests per second on average,
+    with bursts of up to capacity requests.
+    """
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity or max(rate, 1))
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Blocks until a token is available, then takes it.
+        """
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class ApiClient:
+    """
+    HTTP client sharing one pooled requests Session between calls, so
+    connections are kept alive. Responses with a status in retry_statuses
+    and connection errors are retried with exponential backoff (honouring
+    Retry-After), and rate_limit caps requests per second across threads.
+    Only urllib3's idempotent methods are retried, plus any in retry_methods
+    (e.g. ['POST'] for endpoints that are safe to call twice).
+    The session, and requests itself, are only loaded by the first request.
+    """
+    def __init__(self,
+                 pool_size=10,
+                 max_retries=3,
+                 backoff_factor=0.5,
+                 rate_limit=None,
+                 timeout=None,
+                 retry_statuses=RETRY_STATUSES,
+                 retry_methods=()):
+        self.timeout = timeout
+        self.bucket = TokenBucket(rate_limit) if rate_limit else None
+
+        self.pool_size = pool_size
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.retry_statuses = retry_statuses
+        self.retry_methods = retry_methods
+        self._session = None
+        self.lock = threading.Lock()
+
+    @property
+    def session(self):
+        if self._session is None:
+            with self.lock:
+                if self._session is None:
+                    self._session = self.make_session()
+        return self._session
+
+    def make_session(self):
+        retry = urllib3_retry.Retry(total=self.max_retries,
+                                    backoff_factor=self.backoff_factor,
+                                    status_forcelist=self.retry_statuses,
+                                    allowed_methods=self.allowed_methods(),
+                                    respect_retry_after_header=True,
+                                    raise_on_status=False)
+        adapter = requests.adapters.HTTPAdapter(pool_connections=self.pool_size,
+                                                pool_maxsize=self.pool_size,
+                                                max_retries=retry)
+
+        session = requests.Session()
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
+
+    def allowed_methods(self):
+        methods = urllib3_retry.Retry.DEFAULT_ALLOWED_METHODS
+        return methods | {method.upper() for method in self.retry_methods}
+
+    def request(self, method, url, **kwargs):
+        """
+        Sends a request through the pooled session and returns the Response.
+        kwargs are passed to requests.Session.request.
+        """
+        if self.bucket:
+            self.bucket.acquire()
+        kwargs.setdefault('timeout', self.timeout)
+        return self.session.request(method=method, url=url, **kwargs)
+
+    def map(self, func, calls, max_workers=8):
+        """
+        Calls func(**call) for every dict in calls on a pool of at most
+        max_workers threads, returning the results in the order of calls.
+        """
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            return list(executor.map(lambda call: func(**call), calls))
+
+    def close(self):
+        if self._session is not None:
+            self._session.close()
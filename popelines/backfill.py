@@ -0,0 +1,104 @@
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+
+class BackfillError(Exception):
+    """
+    Raised once a backfill has finished if any chunk still failed after its
+    retries. failures maps each failed (start, end) chunk to its exception.
+    """
+    def __init__(self, failures):
+        self.failures = failures
+        chunks = ', '.join(f'{start} to {end}' for start, end in failures)
+        super().__init__(f'{len(failures)} chunk(s) failed: {chunks}')
+
+
+def chunk_key(start, end):
+    return f'{start.isoformat()}/{end.isoformat()}'
+
+
+class Checkpoint:
+    """
+    Records completed chunks in a local line-delimited JSON file, one line per
+    chunk, so a rerun can skip them. Safe to share between threads.
+    """
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self.lock = threading.Lock()
+        self.done = set()
+
+        if os.path.exists(file_name):
+            with open(file_name, 'r') as f:
+                for line in f:
+                    if line.strip():
+                        self.done.add(json.loads(line)['chunk'])
+
+    def is_done(self, start, end):
+        return chunk_key(start, end) in self.done
+
+    def mark_done(self, start, end):
+        key = chunk_key(start, end)
+        with self.lock:
+            with open(self.file_name, 'a') as f:
+                f.write(json.dumps({'chunk': key, 'completed_at': time.time()}) + '\n')
+            self.done.add(key)
+
+
+def run_chunk(func, start, end, retries, retry_delay, log):
+    """
+    Calls func(start, end), retrying up to retries times with exponential
+    backoff.
+    """
+    for attempt in range(retries + 1):
+        try:
+            return func(start, end)
+        except Exception as e:
+            if attempt == retries:
+                raise
+            delay = retry_delay * 2 ** attempt
+            log.info(f'Chunk {start} to {end} failed ({e}), retrying in {delay} seconds')
+            time.sleep(delay)
+
+
+def run_backfill(chunks, func, max_workers=4, checkpoint=None, retries=2, retry_delay=5, log=None):
+    """
+    Runs func(start, end) for every (start, end) in chunks on a pool of
+    max_workers threads, skipping chunks the checkpoint has already seen.
+    Returns a dict of chunk to result, or raises BackfillError once every
+    chunk has been tried if any of them failed.
+    """
+    log = log or logging.getLogger()
+
+    todo = []
+    for start, end in chunks:
+        if checkpoint and checkpoint.is_done(start, end):
+            log.debug(f'Skipping completed chunk {start} to {end}')
+        else:
+            todo.append((start, end))
+    log.info(f'Backfilling {len(todo)} chunk(s) with {max_workers} worker(s)')
+
+    results = {}
+    failures = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            executor.submit(run_chunk, func, start, end, retries, retry_delay, log): (start, end)
+            for start, end in todo}
+        for future in as_completed(futures):
+            start, end = futures[future]
+            try:
+                results[(start, end)] = future.result()
+            except Exception as e:
+                log.info(f'Chunk {start} to {end} failed: {e}')
+                failures[(start, end)] = e
+                continue
+            if checkpoint:
+                checkpoint.mark_done(start, end)
+
+    if failures:
+        raise BackfillError(failures)
+
+    return results
@@ -0,0 +1,37 @@
+import threading
+
+from popelines.lazy import lazy_import
+
+bigquery = lazy_import('google.cloud.bigquery')
+storage = lazy_import('google.cloud.storage')
+
+# clients shared by every popeline in the process, keyed by
+# (kind, service_key_file_loc, project)
+_clients = {}
+_lock = threading.Lock()
+
+
+def get_client(kind, service_key_file_loc=None, project=None):
+    """
+    Returns the shared 'bigquery' or 'storage' client for these credentials
+    and project, creating it the first time it's asked for. Without
+    service_key_file_loc, credentials come from the environment.
+    """
+    key = (kind, service_key_file_loc, project)
+    with _lock:
+        if key not in _clients:
+            module = {'bigquery': bigquery, 'storage': storage}[kind]
+            if service_key_file_loc:
+                client = module.Client.from_service_account_json(service_key_file_loc, project=project)
+            else:
+                client = module.Client(project=project)
+            _clients[key] = client
+        return _clients[key]
+
+
+def clear_clients():
+    """
+    Forgets every shared client, e.g. after a fork or credential rotation.
+    """
+    with _lock:
+        _clients.clear()
@@ -0,0 +1,384 @@
+import base64
+import datetime
+import decimal
+import json
+import os
+
+from popelines.lazy import lazy_import
+from popelines.watermark import coerce_watermark
+
+# optional dependencies, only needed by the format being written
+pyarrow = lazy_import('pyarrow')
+parquet = lazy_import('pyarrow.parquet')
+fastavro = lazy_import('fastavro')
+fastavro_write = lazy_import('fastavro.write')
+
+# load job source formats, by file extension
+SOURCE_FORMATS = {
+    '.parquet': 'PARQUET',
+    '.avro': 'AVRO',
+}
+COLUMNAR_FORMATS = ('PARQUET', 'AVRO')
+
+# legacy and standard SQL names for the same types
+TYPE_ALIASES = {
+    'INT64': 'INTEGER',
+    'FLOAT64': 'FLOAT',
+    'BOOL': 'BOOLEAN',
+    'STRUCT': 'RECORD',
+    'DECIMAL': 'NUMERIC',
+    'BIGDECIMAL': 'BIGNUMERIC',
+}
+
+
+def source_format(file_name):
+    """
+    Returns the load job source format of file_name, going by its extension.
+    Anything that isn't Parquet or Avro is taken to be NDJSON.
+    """
+    for extension, format in SOURCE_FORMATS.items():
+        if file_name.endswith(extension):
+            return format
+    return 'NEWLINE_DELIMITED_JSON'
+
+
+def columnar_file_name(file_name, format):
+    """
+    Returns file_name with its .json or .json.gz extension swapped for
+    format's, e.g. data.json.gz -> data.parquet.
+    """
+    for extension in ('.json.gz', '.json', '.gz'):
+        if file_name.endswith(extension):
+            file_name = file_name[:-len(extension)]
+            break
+    return f'{file_name}.{format.lower()}'
+
+
+def field_type(field):
+    field_type = field['type'].upper()
+    return TYPE_ALIASES.get(field_type, field_type)
+
+
+def _utc(value):
+    if value.tzinfo is None:
+        return value.replace(tzinfo=datetime.timezone.utc)
+    return value
+
+
+def _datetime(value):
+    value = coerce_watermark(value)
+    if isinstance(value, datetime.datetime):
+        return value
+    if isinstance(value, datetime.date):
+        return datetime.datetime(value.year, value.month, value.day)
+    if isinstance(value, (int, float)):
+        return datetime.datetime.fromtimestamp(value, datetime.timezone.utc)
+    raise ValueError(f'{value!r} is not a timestamp')
+
+
+def _date(value):
+    if isinstance(value, datetime.datetime):
+        return value.date()
+    if isinstance(value, datetime.date):
+        return value
+    return _datetime(value).date()
+
+
+# what BigQuery accepts for a BOOLEAN
+BOOLEANS = {'true': True, 'false': False, '1': True, '0': False}
+
+
+def _integer(value):
+    # refuse anything that would lose information, as an NDJSON load would
+    if type(value) is int:
+        return value
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    if isinstance(value, str):
+        return int(value)
+    raise ValueError(f"{value!r} isn't an integer")
+
+
+def _float(value):
+    if type(value) is float:
+        return value
+    if isinstance(value, (int, str)) and not isinstance(value, bool):
+        return float(value)
+    raise ValueError(f"{value!r} isn't a number")
+
+
+def _boolean(value):
+    if isinstance(value, bool):
+        return value
+    if isinstance(value, str) and value.strip().lower() in BOOLEANS:
+        return BOOLEANS[value.strip().lower()]
+    if type(value) is int and value in (0, 1):
+        return bool(value)
+    raise ValueError(f"{value!r} isn't a boolean")
+
+
+def _string(value):
+    # JSON, GEOGRAPHY and the like load from strings too
+    if type(value) is str:
+        return value
+    return json.dumps(value, default=str)
+
+
+def scalar_converter(field, avro=False):
+    bq_type = field_type(field)
+
+    if bq_type == 'RECORD':
+        convert_fields = record_converter(field.get('fields', []), avro=avro)
+
+        def convert_record(value):
+            if not isinstance(value, dict):
+                raise ValueError(f"Can't write {value!r} to record column {field['name']}")
+            return convert_fields(value)
+        return convert_record
+
+    if bq_type == 'DATETIME':
+        if avro:
+            # BigQuery reads DATETIMEs out of Avro as annotated strings
+            return lambda value: _datetime(value).replace(tzinfo=None).isoformat()
+        return lambda value: _datetime(value).replace(tzinfo=None)
+
+    # values that are already the right type are passed straight through
+    return {
+        'INTEGER': _integer,
+        'FLOAT': _float,
+        'BOOLEAN': _boolean,
+        'TIMESTAMP': lambda value: _utc(_datetime(value)),
+        'DATE': _date,
+        'TIME': lambda value: datetime.time.fromisoformat(value) if isinstance(value, str) else value,
+        'NUMERIC': lambda value: decimal.Decimal(str(value)),
+        'BIGNUMERIC': lambda value: decimal.Decimal(str(value)),
+        'BYTES': lambda value: base64.b64decode(value) if isinstance(value, str) else bytes(value),
+    }.get(bq_type, _string)
+
+
+def converter(field, avro=False):
+    """
+    Returns a function converting a value from a JSON record into what
+    pyarrow or fastavro expect for field, e.g. ISO strings into datetimes for
+    TIMESTAMP columns and ints into floats for FLOAT columns. Working out the
+    conversion once per field keeps the per-value cost down.
+    """
+    convert_scalar = scalar_converter(field, avro=avro)
+
+    def convert(value):
+        try:
+            return convert_scalar(value)
+        except (ValueError, TypeError, ArithmeticError) as e:
+            raise ValueError(f"Can't write {value!r} to {field['type']} column {field['name']}: {e}") from e
+
+    if field.get('mode') == 'REPEATED':
+        def convert_repeated(value):
+            if value is None:
+                return []
+            if not isinstance(value, list):
+                value = [value]
+            # BigQuery arrays can't hold nulls
+            return [convert(item) for item in value if item is not None]
+        return convert_repeated
+
+    def convert_nullable(value):
+        return None if value is None else convert(value)
+    return convert_nullable
+
+
+def record_converter(fields, avro=False):
+    """
+    Returns a function converting a record to just the columns in fields,
+    coerced to their types.
+    """
+    converters = [(field['name'], converter(field, avro=avro)) for field in fields]
+
+    def convert_record(record):
+        return {name: convert(record.get(name)) for name, convert in converters}
+    return convert_record
+
+
+def arrow_column(values, field, arrow_type):
+    """
+    Builds field's column from JSON values in pyarrow alone, without
+    converting them in Python first, if they're all of the expected type or
+    ISO strings pyarrow can parse. Returns None if they aren't.
+    """
+    if field.get('mode') == 'REPEATED':
+        return None
+    bq_type = field_type(field)
+    try:
+        if bq_type in ('STRING', 'INTEGER', 'FLOAT', 'BOOLEAN'):
+            # let pyarrow work out the type itself, since converting to the
+            # column's type would silently truncate floats and count bools
+            column = pyarrow.array(values)
+            if column.type == arrow_type or column.type == pyarrow.null():
+                return column.cast(arrow_type)
+            if bq_type == 'FLOAT' and column.type == pyarrow.int64():
+                return column.cast(arrow_type)
+            return None
+        if bq_type in ('TIMESTAMP', 'DATE'):
+            return pyarrow.array(values, type=pyarrow.string()).cast(arrow_type)
+    except (pyarrow.ArrowInvalid, pyarrow.ArrowTypeError, TypeError, ValueError, OverflowError):
+        pass
+    return None
+
+
+def arrow_type(field):
+    bq_type = field_type(field)
+    if bq_type == 'RECORD':
+        value_type = pyarrow.struct([arrow_field(sub) for sub in field.get('fields', [])])
+    else:
+        value_type = {
+            'STRING': pyarrow.string,
+            'INTEGER': pyarrow.int64,
+            'FLOAT': pyarrow.float64,
+            'BOOLEAN': pyarrow.bool_,
+            'TIMESTAMP': lambda: pyarrow.timestamp('us', tz='UTC'),
+            'DATETIME': lambda: pyarrow.timestamp('us'),
+            'DATE': pyarrow.date32,
+            'TIME': lambda: pyarrow.time64('us'),
+            'NUMERIC': lambda: pyarrow.decimal128(38, 9),
+            'BIGNUMERIC': lambda: pyarrow.decimal256(76, 38),
+            'BYTES': pyarrow.binary,
+        }.get(bq_type, pyarrow.string)()
+
+    if field.get('mode') == 'REPEATED':
+        return pyarrow.list_(value_type)
+    return value_type
+
+
+def arrow_field(field):
+    return pyarrow.field(field['name'], arrow_type(field), nullable=field.get('mode') != 'REQUIRED')
+
+
+def arrow_schema(fields):
+    """
+    Converts a BigQuery schema in its API representation to a pyarrow schema.
+    """
+    return pyarrow.schema([arrow_field(field) for field in fields])
+
+
+def avro_type(field, path):
+    bq_type = field_type(field)
+    if bq_type == 'RECORD':
+        # Avro record names have to be unique, so name them by their path
+        value_type = {
+            'type': 'record',
+            'name': '_'.join(path),
+            'fields': [avro_field(sub, path + [sub['name']]) for sub in field.get('fields', [])],
+        }
+    else:
+        value_type = {
+            'STRING': 'string',
+            'INTEGER': 'long',
+            'FLOAT': 'double',
+            'BOOLEAN': 'boolean',
+            'TIMESTAMP': {'type': 'long', 'logicalType': 'timestamp-micros'},
+            'DATETIME': {'type': 'string', 'sqlType': 'DATETIME'},
+            'DATE': {'type': 'int', 'logicalType': 'date'},
+            'TIME': {'type': 'long', 'logicalType': 'time-micros'},
+            'NUMERIC': {'type': 'bytes', 'logicalType': 'decimal', 'precision': 38, 'scale': 9},
+            'BIGNUMERIC': {'type': 'bytes', 'logicalType': 'decimal', 'precision': 76, 'scale': 38},
+            'BYTES': 'bytes',
+        }.get(bq_type, 'string')
+
+    if field.get('mode') == 'REPEATED':
+        return {'type': 'array', 'items': value_type}
+    return value_type
+
+
+def avro_field(field, path):
+    value_type = avro_type(field, path)
+    if field.get('mode') in ('REQUIRED', 'REPEATED'):
+        return {'name': field['name'], 'type': value_type}
+    return {'name': field['name'], 'type': ['null', value_type], 'default': None}
+
+
+def avro_schema(fields, name='root'):
+    """
+    Converts a BigQuery schema in its API representation to an Avro schema.
+    """
+    return {
+        'type': 'record',
+        'name': name,
+        'fields': [avro_field(field, [name, field['name']]) for field in fields],
+    }
+
+
+class ColumnarWriter:
+    """
+    Writes records to a Parquet or Avro file with the BigQuery schema fields.
+    Records are buffered batch_size at a time and written out a batch (a
+    Parquet row group, or an Avro block) at a time, so memory stays bounded
+    however many records are written. Parquet needs pyarrow and Avro needs
+    fastavro.
+    """
+    def __init__(self, file_name, fields, format=None, batch_size=10000, compression=None):
+        self.file_name = file_name
+        self.fields = fields
+        self.format = (format or source_format(file_name)).upper()
+        self.batch_size = batch_size
+        self.batch = []
+        self.row_count = 0
+        self.byte_count = 0
+
+        if self.format == 'PARQUET':
+            self.schema = arrow_schema(fields)
+            self.converters = [(field['name'], converter(field)) for field in fields]
+            self.writer = parquet.ParquetWriter(file_name, self.schema, compression=compression or 'snappy')
+        elif self.format == 'AVRO':
+            self.file = open(file_name, 'wb')
+            schema = fastavro.parse_schema(avro_schema(fields))
+            self.convert = record_converter(fields, avro=True)
+            self.writer = fastavro_write.Writer(self.file, schema, codec=compression or 'deflate')
+        else:
+            raise ValueError(f'Unknown columnar format {format!r} for {file_name}, expected parquet or avro')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def write(self, record):
+        self.batch.append(record)
+        if len(self.batch) >= self.batch_size:
+            self.flush()
+
+    def write_many(self, records):
+        for record in records:
+            self.write(record)
+
+    def flush(self):
+        if not self.batch:
+            return
+
+        if self.format == 'PARQUET':
+            columns = []
+            for field, (name, convert), arrow_field in zip(self.fields, self.converters, self.schema):
+                values = [record.get(name) for record in self.batch]
+                # only coerce values in Python if pyarrow can't take them as they are
+                column = arrow_column(values, field, arrow_field.type)
+                if column is None:
+                    column = pyarrow.array([convert(value) for value in values], type=arrow_field.type)
+                columns.append(column)
+            self.writer.write_batch(pyarrow.RecordBatch.from_arrays(columns, schema=self.schema))
+        else:
+            for record in self.batch:
+                self.writer.write(self.convert(record))
+            self.writer.flush()
+
+        self.row_count += len(self.batch)
+        self.batch = []
+
+    def close(self):
+        if self.writer is None:
+            return
+        self.flush()
+        if self.format == 'PARQUET':
+            self.writer.close()
+        else:
+            self.file.close()
+        self.writer = None
+        self.byte_count = os.path.getsize(self.file_name)
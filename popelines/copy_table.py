@@ -1,3 +1,5 @@
+import functools
+
 type_conversion = {
     'INTEGER': 'INT64',
     'STRING': 'STRING',
@@ -8,62 +10,70 @@ type_conversion = {
     'DATE': 'DATE'
 }
 
+# SchemaFields are hashable, so the SQL for a nested field is only generated
+# once per callback, however many tables share it
+@functools.lru_cache(maxsize=4096)
 def process_struct_type(field, spaces, key_callback):
     if field.mode == "REPEATED":
-        type_q = f"\n{spaces * ' '}ARRAY<STRUCT<\n"
+        type_q = [f"\n{spaces * ' '}ARRAY<STRUCT<\n"]
     else:
-        type_q = f"\n{spaces * ' '}STRUCT<\n"
-    
+        type_q = [f"\n{spaces * ' '}STRUCT<\n"]
+
     subfields = field.fields
     for subfield in subfields:
         if subfield.field_type != 'RECORD':
             if subfield.mode == "REPEATED":
-                type_q += f"{(spaces + 2 )* ' '}`{key_callback(subfield.name)}` ARRAY<{type_conversion[subfield.field_type]}>,\n"
+                type_q.append(f"{(spaces + 2 )* ' '}`{key_callback(subfield.name)}` ARRAY<{type_conversion[subfield.field_type]}>,\n")
             else:
-                type_q += f"{(spaces + 2 )* ' '}`{key_callback(subfield.name)}` {type_conversion[subfield.field_type]},\n"
+                type_q.append(f"{(spaces + 2 )* ' '}`{key_callback(subfield.name)}` {type_conversion[subfield.field_type]},\n")
         else:
-            type_q += f"{(spaces + 2) * ' '}`{key_callback(subfield.name)}` {process_struct_type(subfield, spaces + 2, key_callback)},\n"
-            
-    type_q = type_q.rstrip(',\n').rstrip(',')
-    
+            type_q.append(f"{(spaces + 2) * ' '}`{key_callback(subfield.name)}` {process_struct_type(subfield, spaces + 2, key_callback)},\n")
+
+    type_q = ''.join(type_q).rstrip(',\n').rstrip(',')
+
     if field.mode == "REPEATED":
         type_q += f"\n{spaces * ' '}>>"
     else:
         type_q += f"\n{spaces * ' '}>"
-    
+
     return type_q
-    
+
 def process_struct_data(field, parent_cols, spaces):
+    return _process_struct_data(field, tuple(parent_cols), spaces)
+
+@functools.lru_cache(maxsize=4096)
+def _process_struct_data(field, parent_cols, spaces):
     if field.mode == "REPEATED":
-        data_q = f"\n{spaces * ' '}[STRUCT(\n"
-        parent_cols = [field.name]
+        data_q = [f"\n{spaces * ' '}[STRUCT(\n"]
+        parent_cols = (field.name,)
     else:
-        data_q = f"\n{spaces * ' '}STRUCT(\n"
-    
+        data_q = [f"\n{spaces * ' '}STRUCT(\n"]
+
     subfields = field.fields
     for subfield in subfields:
         if subfield.field_type != 'RECORD':
-            data_q += f"{(spaces + 2) * ' '}{'.'.join([f'`{x}`' for x in parent_cols + [subfield.name]]).strip(',')},\n"
+            data_q.append(f"{(spaces + 2) * ' '}{'.'.join([f'`{x}`' for x in parent_cols + (subfield.name,)]).strip(',')},\n")
         else:
-            data_q += f"{(spaces + 2) * ' '}{process_struct_data(subfield, parent_cols + [subfield.name], spaces + 2)}"
-            
-    data_q = data_q.strip(',\n')
-            
+            data_q.append(f"{(spaces + 2) * ' '}{_process_struct_data(subfield, parent_cols + (subfield.name,), spaces + 2)}")
+
+    data_q = ''.join(data_q).strip(',\n')
+
     if field.mode == "REPEATED":
         data_q += ")],\n"
     else:
         data_q += "),\n"
-            
+
     return data_q
 
 def process_cross_joins(field, parent_table):
-    cross_joins = []
-    
+    # a dict keeps the joins in order while dropping duplicates in constant time
+    cross_joins = {}
+
     # repeated fields of record type must be added
     if field.mode == "REPEATED" and field.field_type == "RECORD":
         cj = f'\nLEFT JOIN UNNEST({parent_table}.{field.name}) {field.name}'
-        cross_joins.append(cj)
-        
+        cross_joins[cj] = None
+
     # if we come across a field that is a record, but is not repeated, then some
     # of its subfields may be repeated, so we need to recurse through it
     if field.field_type == 'RECORD':
@@ -71,15 +81,11 @@ def process_cross_joins(field, parent_table):
             parent_table = field.name
         else:
             parent_table = parent_table + '.' + field.name
-        
+
         for subfield in field.fields:
-            cjs = process_cross_joins(subfield, parent_table)
+            cross_joins.update(dict.fromkeys(process_cross_joins(subfield, parent_table)))
 
-            for cj in cjs:
-                if cj not in cross_joins:
-                    cross_joins.append(cj)
-    
-    return cross_joins
+    return list(cross_joins)
 
 def process_field(field, prefix, key_callback):
     field_text = ''
@@ -93,5 +99,36 @@ def process_field(field, prefix, key_callback):
         field_text = type_q.strip(",\n") + data_q
         field_text = field_text.strip(",\n")
         field_text += f" `{field.name.lower()}`,\n"
-        
-    return field_text
\ No newline at end of file
+
+    return field_text
+
+def keys_unchanged(fields, key_callback, top_level=True):
+    """
+    Returns True if rewriting a table with these fields would leave every
+    column name as it is, so the table can be skipped.
+    """
+    for field in fields:
+        if key_callback(field.name) != field.name:
+            return False
+        if field.field_type == 'RECORD':
+            # top level records are aliased with their lowercased name
+            if top_level and field.name.lower() != field.name:
+                return False
+            if not keys_unchanged(field.fields, key_callback, top_level=False):
+                return False
+    return True
+
+def build_copy_query(table, fields, key_callback):
+    """
+    Returns a query for copying and replacing table, applying key_callback to
+    each column name.
+    """
+    q = [f'CREATE OR REPLACE TABLE `{table}` AS (\nSELECT \n']
+    cross_joins = []
+    for field in fields:
+        q.append(process_field(field, None, key_callback))
+        cross_joins.extend(process_cross_joins(field, "copy_table"))
+    q = ''.join(q).strip(",\n")
+    q += f"\nFROM\n  `{table}` copy_table"
+
+    return q + ''.join(cross_joins) + ")"
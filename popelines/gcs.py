@@ -0,0 +1,60 @@
+import math
+import mimetypes
+import os
+
+from popelines.lazy import lazy_import
+
+storage_retry = lazy_import('google.cloud.storage.retry')
+transfer_manager = lazy_import('google.cloud.storage.transfer_manager')
+
+# resumable upload chunks must be a multiple of 256 KiB
+CHUNK_GRANULARITY = 256 * 1024
+CHUNK_SIZE = 32 * CHUNK_GRANULARITY
+# parts of a parallel (XML multipart) upload must be at least 5 MiB
+MIN_PART_SIZE = 5 * 1024 * 1024
+
+
+def guess_content_type(file_name):
+    if file_name.endswith('.gz'):
+        return 'application/gzip'
+    return mimetypes.guess_type(file_name)[0] or 'application/octet-stream'
+
+
+def check_chunk_size(chunk_size):
+    if chunk_size <= 0 or chunk_size % CHUNK_GRANULARITY:
+        raise ValueError(f'chunk_size must be a positive multiple of 256 KiB, not {chunk_size}')
+
+
+def resumable_upload(blob, file_name, chunk_size=CHUNK_SIZE, content_type=None, retry=None):
+    """
+    Streams file_name to blob in chunk_size pieces through the storage
+    client's resumable upload, so only one chunk is in memory at a time.
+    Failed requests are retried with retry (the client's DEFAULT_RETRY by
+    default), and the client checks the object's CRC32C once it's written,
+    raising DataCorruption on a mismatch. chunk_size must be a multiple of
+    256 KiB; see check_chunk_size.
+    """
+    blob.chunk_size = chunk_size
+    blob.upload_from_filename(file_name,
+                              content_type=content_type or guess_content_type(file_name),
+                              checksum='crc32c',
+                              retry=retry or storage_retry.DEFAULT_RETRY)
+    return blob
+
+
+def parallel_upload(blob, file_name, parts=32, max_workers=8, min_part_size=MIN_PART_SIZE):
+    """
+    Uploads file_name to blob as up to parts pieces on max_workers threads,
+    with the storage client's transfer manager. Each piece is CRC32C checked
+    and GCS puts them together into one object.
+    """
+    size = os.path.getsize(file_name)
+    part_size = max(math.ceil(size / max(parts, 1)), min_part_size, MIN_PART_SIZE)
+    transfer_manager.upload_chunks_concurrently(file_name,
+                                                blob,
+                                                content_type=guess_content_type(file_name),
+                                                chunk_size=part_size,
+                                                worker_type=transfer_manager.THREAD,
+                                                max_workers=max_workers,
+                                                checksum='crc32c')
+    return blob
@@ -0,0 +1,117 @@
+import logging
+import threading
+import time
+
+
+class JobError(Exception):
+    """
+    Raised by JobManager.wait_all if any job failed. errors maps the label
+    and id of each failed job to its errors.
+    """
+    def __init__(self, errors):
+        self.errors = errors
+        details = '; '.join(f'{label}: {error}' for label, error in errors.items())
+        super().__init__(f'{len(errors)} job(s) failed: {details}')
+
+
+class JobManager:
+    """
+    Tracks BigQuery jobs that were started without waiting for them. At most
+    max_in_flight jobs run at once; wait_for_slot blocks until there's room
+    for another. Jobs are polled with a single pass over everything in flight,
+    backing off from poll_interval to max_poll_interval seconds while nothing
+    finishes. Errors checking on a job are retried on later polls, and only
+    raised once a job has failed to be checked max_poll_errors times in a row.
+    """
+    def __init__(self, max_in_flight=10, poll_interval=0.5, max_poll_interval=10, max_poll_errors=5, log=None):
+        self.max_in_flight = max_in_flight
+        self.poll_interval = poll_interval
+        self.max_poll_interval = max_poll_interval
+        self.max_poll_errors = max_poll_errors
+        self.log = log or logging.getLogger()
+
+        self.in_flight = []
+        self.errors = {}
+        self.poll_errors = {}
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.in_flight)
+
+    def add(self, job, label=None, on_done=None):
+        """
+        Starts tracking job. on_done(job, succeeded) is called once it
+        finishes.
+        """
+        label = label or job.job_id
+        with self.lock:
+            self.in_flight.append((job, label, on_done))
+        self.log.debug(f'Tracking job {job.job_id} ({label}), {len(self.in_flight)} in flight')
+        return job
+
+    def poll(self):
+        """
+        Checks every job in flight once. Returns the number that finished.
+        """
+        with self.lock:
+            jobs = list(self.in_flight)
+
+        finished = 0
+        for entry in jobs:
+            job, label, on_done = entry
+            try:
+                if not job.done():
+                    continue
+            except Exception as e:
+                # couldn't reach the API, not a failed job - try again later
+                with self.lock:
+                    failures = self.poll_errors[job.job_id] = self.poll_errors.get(job.job_id, 0) + 1
+                if failures >= self.max_poll_errors:
+                    raise
+                self.log.info(f'Checking job {job.job_id} ({label}) failed, will retry: {e}')
+                continue
+            error = job.error_result and (job.errors or job.error_result)
+
+            # another thread polling at the same time may have got here first
+            with self.lock:
+                if entry not in self.in_flight:
+                    continue
+                self.in_flight.remove(entry)
+                self.poll_errors.pop(job.job_id, None)
+            finished += 1
+
+            if error:
+                self.log.info(f'Job {job.job_id} ({label}) failed: {error}')
+                self.errors[f'{label} ({job.job_id})'] = error
+            else:
+                self.log.debug(f'Job {job.job_id} ({label}) done')
+            if on_done:
+                on_done(job, not error)
+
+        return finished
+
+    def wait(self, until):
+        interval = self.poll_interval
+        while not until():
+            if self.poll():
+                interval = self.poll_interval
+                continue
+            time.sleep(interval)
+            interval = min(interval * 2, self.max_poll_interval)
+
+    def wait_for_slot(self):
+        """
+        Blocks until fewer than max_in_flight jobs are running.
+        """
+        self.wait(lambda: len(self.in_flight) < self.max_in_flight)
+
+    def wait_all(self):
+        """
+        Blocks until every job has finished, then raises a JobError listing
+        every job that failed since the last wait_all.
+        """
+        self.wait(lambda: not self.in_flight)
+
+        errors, self.errors = self.errors, {}
+        if errors:
+            raise JobError(errors)
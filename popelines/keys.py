@@ -0,0 +1,118 @@
+import functools
+import re
+
+KEY_CACHE_SIZE = 10000
+
+# "." and " " become "_", anything else that isn't alphanumeric or "_" is dropped
+separator_re = re.compile(r"[. ]")
+invalid_re = re.compile(r"[^a-zA-Z0-9_]")
+
+
+@functools.lru_cache(maxsize=KEY_CACHE_SIZE)
+def prep_key_for_BQ(key):
+    """
+    Turns a JSON key into a valid BigQuery column name. Results are cached,
+    since API payloads repeat the same keys over and over.
+    """
+    # add _ if first character in key is numeric
+    if key[:1].isnumeric():
+        key = "_" + key
+    key = separator_re.sub("_", key)
+    key = invalid_re.sub("", key)
+    return key
+
+
+def cache_callback(callback, maxsize=KEY_CACHE_SIZE):
+    """
+    Wraps a key callback in a bounded LRU cache. Only use this for callbacks
+    whose result depends on nothing but the key.
+    """
+    return functools.lru_cache(maxsize=maxsize)(callback)
+
+
+def _is_container(obj):
+    return isinstance(obj, (dict, list))
+
+
+def _empty_like(obj):
+    return {} if isinstance(obj, dict) else []
+
+
+def fix_keys(obj, callback, in_place=False):
+    """
+    Runs all keys in a JSON object (dict or list) through callback. Walks the
+    object with an explicit stack, so depth isn't limited by the recursion
+    limit. If in_place is set, obj itself is modified instead of copied.
+    """
+    if not _is_container(obj):
+        return obj
+
+    root = obj if in_place else _empty_like(obj)
+    stack = [(obj, root)]
+    while stack:
+        src, dst = stack.pop()
+        if isinstance(src, dict):
+            items = list(src.items())
+            new_keys = [callback(key) for key, _ in items]
+            if in_place:
+                # don't rebuild dicts whose keys are already fine
+                if all(new_key == key for new_key, (key, _) in zip(new_keys, items)):
+                    stack.extend((value, value) for _, value in items if _is_container(value))
+                    continue
+                dst.clear()
+            for new_key, (_, value) in zip(new_keys, items):
+                if _is_container(value):
+                    child = value if in_place else _empty_like(value)
+                    stack.append((value, child))
+                    dst[new_key] = child
+                else:
+                    dst[new_key] = value
+        else:
+            for value in src:
+                if _is_container(value):
+                    child = value if in_place else _empty_like(value)
+                    stack.append((value, child))
+                else:
+                    child = value
+                if not in_place:
+                    dst.append(child)
+
+    return root
+
+
+def fix_values(obj, callback, in_place=False, **kwargs):
+    """
+    Runs all values in a JSON object (dict or list) through callback, called
+    as callback(value, key, **kwargs). Dict values that are themselves dicts
+    or lists are passed to callback before being walked. Walks the object with
+    an explicit stack; if in_place is set, obj itself is modified.
+    """
+    if not _is_container(obj):
+        return obj
+
+    root = obj if in_place else _empty_like(obj)
+    stack = [(obj, root)]
+    while stack:
+        src, dst = stack.pop()
+        if isinstance(src, dict):
+            for key, value in list(src.items()):
+                if _is_container(value):
+                    value = callback(value, key, **kwargs)
+                    if _is_container(value):
+                        child = value if in_place else _empty_like(value)
+                        stack.append((value, child))
+                        value = child
+                    dst[key] = value
+                else:
+                    dst[key] = callback(value, key, **kwargs)
+        else:
+            for value in src:
+                if _is_container(value):
+                    child = value if in_place else _empty_like(value)
+                    stack.append((value, child))
+                else:
+                    child = value
+                if not in_place:
+                    dst.append(child)
+
+    return root
@@ -1,13 +1,32 @@
 import json
-from google.cloud import bigquery
-from google.cloud import storage
-from popelines.copy_table import process_field, process_cross_joins
+from popelines.copy_table import build_copy_query, keys_unchanged
+from popelines.schema import SchemaBuilder, merge_schemas
+from popelines.writer import JsonWriter, open_ndjson, wrap_ndjson
+from popelines.columnar import ColumnarWriter, COLUMNAR_FORMATS, columnar_file_name, source_format as get_source_format
+from popelines.keys import prep_key_for_BQ, cache_callback, fix_keys, fix_values
+from popelines.api import ApiClient
+from popelines.pagination import Paginator
+from popelines.backfill import Checkpoint, run_backfill
+from popelines.gcs import resumable_upload, parallel_upload, check_chunk_size, CHUNK_SIZE
+from popelines.jobs import JobManager
+from popelines.query import QueryCache, row_to_json, rows_to_columns
+from popelines.watermark import WatermarkTracker, LocalWatermarkStore, TableWatermarkStore, later
+from popelines.metrics import Metrics
+from popelines.clients import get_client
+from popelines.lazy import lazy_import
 import os
 import logging
-import requests
 import sys
 import datetime
-import re
+import time
+import copy
+import types
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+# imported on first use, so jobs that never touch BQ don't pay for it
+bigquery = lazy_import('google.cloud.bigquery')
+exceptions = lazy_import('google.api_core.exceptions')
 
 class popeline:
     """
@@ -18,30 +37,90 @@ class popeline:
                  project=None, 
                  service_key_file_loc=None, 
                  directory='.', 
-                 verbose=False):
-
-        # set up GCS and BQ clients - if no service_account_json provided, then pull
-        # from environment variable
-        if service_key_file_loc:
-            self.bq_client = bigquery.Client.from_service_account_json(service_key_file_loc)
-            self.gcs_client = storage.Client.from_service_account_json(service_key_file_loc)
-        else:
-            self.bq_client = bigquery.Client()
-            self.gcs_client = storage.Client()
+                 verbose=False,
+                 schema_cache_ttl=300,
+                 max_jobs_in_flight=10,
+                 bq_client=None,
+                 gcs_client=None,
+                 metrics_sinks=None,
+                 profile=False):
+
+        # GCS and BQ clients are created on first use, and shared with other
+        # popelines using the same credentials and project - if no
+        # service_account_json provided, then pull from environment variable.
+        # clients can also be passed in ready-made
+        self.project = project
+        self.service_key_file_loc = service_key_file_loc
+        self._bq_client = bq_client
+        self._gcs_client = gcs_client
 
         # if a project is provided, set that project
         if project:
-            self.bq_client.project = project
-            self.gcs_client.project = project
+            for client in (bq_client, gcs_client):
+                if client:
+                    client.project = project
 
         # set up a logger
         self.log = self.get_logger(verbose)
 
+        # per-stage timings and counts, sent to each of metrics_sinks. off (and
+        # free) unless there's a sink; see add_metrics_sink
+        self.metrics = Metrics(metrics_sinks, profile=profile)
+
         # get local directory
         self.directory = directory
 
         self.dataset_id = dataset_id
 
+        # schemas accumulated by write_to_json, keyed by file name, so that
+        # write_to_bq doesn't have to re-read the file
+        self.file_schemas = {}
+
+        # schemas of BQ tables, keyed by table name, as (fields, time fetched).
+        # entries older than schema_cache_ttl seconds are fetched again.
+        self.table_schemas = {}
+        self.schema_cache_ttl = schema_cache_ttl
+
+        # LRU-cached versions of the key callbacks passed to fix_json_keys
+        self.key_callbacks = {}
+
+        # pooled HTTP client used by call_api; see configure_api
+        self.api_client = ApiClient()
+
+        # GCS buckets, keyed by name, so we only look each one up once
+        self.buckets = {}
+
+        # high-water marks of loaded tables, used by find_last_entry, and the
+        # maxima of watermark_columns seen by write_to_json, keyed by file name
+        self.watermarks = LocalWatermarkStore(f'{self.directory}/.popelines_watermarks.json')
+        self.file_watermarks = {}
+
+        # on-disk cache of query results, used by bq_query(use_cache=True)
+        self.query_cache = QueryCache(f'{self.directory}/.popelines_query_cache')
+
+        # BQ jobs started without waiting for them; see wait_all
+        self.jobs = JobManager(max_in_flight=max_jobs_in_flight, log=self.log)
+
+    @property
+    def bq_client(self):
+        if self._bq_client is None:
+            self._bq_client = get_client('bigquery', self.service_key_file_loc, self.project)
+        return self._bq_client
+
+    @bq_client.setter
+    def bq_client(self, client):
+        self._bq_client = client
+
+    @property
+    def gcs_client(self):
+        if self._gcs_client is None:
+            self._gcs_client = get_client('storage', self.service_key_file_loc, self.project)
+        return self._gcs_client
+
+    @gcs_client.setter
+    def gcs_client(self, client):
+        self._gcs_client = client
+
     def get_logger(self, verbose):
         """
         Does basically what you would expect. 
@@ -50,79 +129,153 @@ class popeline:
 
         log = logging.getLogger()
         log.setLevel(log_levels[int(verbose)])
-        
-        ch = logging.StreamHandler(sys.stdout)
+
+        # only ever add one handler, however many popelines are made
+        handlers = [h for h in log.handlers if getattr(h, 'popelines', False)]
+        if handlers:
+            ch = handlers[0]
+        else:
+            ch = logging.StreamHandler(sys.stdout)
+            ch.popelines = True
+            formatter = logging.Formatter('%(asctime)s - %(name)s - %(message)s')
+            ch.setFormatter(formatter)
+            log.addHandler(ch)
         ch.setLevel(log_levels[int(verbose)])
-        formatter = logging.Formatter('%(asctime)s - %(name)s - %(message)s')
-        ch.setFormatter(formatter)
-        log.addHandler(ch)
 
         return log
 
-    def generate_bq_schema(self, file_name, schema_file_name=None):
+    def add_metrics_sink(self, sink):
         """
-        Uses CLI tool bigquery_schema_generator to generate an API
-        representation of a schema
+        Starts sending a record of every pipeline stage to sink, which is called
+        with a dict per stage. See popelines.metrics for JSON log, Prometheus
+        text file and callback sinks.
         """
-        if not schema_file_name:
-            schema_file_name = f'{self.directory}/schema_temp.json'
-        os.system(f"generate-schema --keep_nulls < {file_name} > {schema_file_name}")
+        self.metrics.add_sink(sink)
 
-        schema = open(schema_file_name, 'r').read()
-
-        os.remove(schema_file_name)
-
-        return json.loads(schema)
+    def generate_bq_schema(self, file_name, schema_file_name=None):
+        """
+        Generates an API representation of the schema of the NDJSON file at
+        file_name. If the file was written by write_to_json, the schema built
+        while writing it is reused; otherwise the file is read once, line by
+        line. schema_file_name is no longer used and is kept for compatibility.
+        """
+        with self.metrics.stage('generate_bq_schema', file_name=file_name) as stage:
+            if file_name in self.file_schemas:
+                builder = self.file_schemas[file_name]
+                stage.add(cached=True)
+            elif file_name.startswith('gs://'):
+                with self.get_gcs_blob(file_name).open('rb') as raw:
+                    builder = SchemaBuilder().add_lines(wrap_ndjson(raw))
+            else:
+                builder = SchemaBuilder().add_file(file_name)
+
+            stage.add(rows=builder.row_count)
+            return builder.schema()
+
+    def get_gcs_blob(self, uri):
+        """
+        Returns the blob for a gs://bucket/path URI.
+        """
+        bucket_name, _, path = uri[len('gs://'):].partition('/')
+        return self.gcs_client.bucket(bucket_name).blob(path)
 
     def merge_schemas(self, old_schm, new_schm):
         """
         Run through new_schm and add any fields not in old_schm
         to old_schm.
         """
+        return merge_schemas(old_schm, new_schm)
+
+    def get_table_schema(self, table_name):
+        """
+        Returns the API representation of the schema of table_name, or None
+        if the table doesn't exist. Schemas are cached for schema_cache_ttl
+        seconds.
+        """
+        cached = self.table_schemas.get(table_name)
+        if cached and (self.schema_cache_ttl is None or time.time() - cached[1] < self.schema_cache_ttl):
+            return copy.deepcopy(cached[0])
 
-        old_schm_cols = [x['name'] for x in old_schm]
+        table_ref = self.bq_client.dataset(self.dataset_id).table(table_name)
+        try:
+            table = self.bq_client.get_table(table_ref)
+        except exceptions.NotFound:
+            self.table_schemas.pop(table_name, None)
+            return None
 
-        for col in new_schm:
-            if type(col) == dict:
-                if col['name'] not in old_schm_cols:
-                    old_schm.append(col)
-        
-        for count, old_col in enumerate(old_schm):
-            for meta in old_col:
-                if type(old_col[meta]) == list:
-                    if old_col['name'] in [pot_new_col['name'] for pot_new_col in new_schm]:
-                        new_col = [pot_new_col for pot_new_col in new_schm if pot_new_col['name'] == old_col['name']][0]
-                        if meta in new_col:
-                            old_schm[count][meta] = self.merge_schemas(old_col[meta], new_col[meta])
-                    
-        return old_schm
+        fields = table.to_api_repr()['schema']['fields']
+        self.table_schemas[table_name] = (fields, time.time())
+        return copy.deepcopy(fields)
+
+    def invalidate_schema_cache(self, table_name=None):
+        """
+        Forget the cached schema of table_name, or of every table if no
+        table_name is given.
+        """
+        if table_name:
+            self.table_schemas.pop(table_name, None)
+        else:
+            self.table_schemas.clear()
 
     def write_to_bq(self, 
                     table_name, 
                     file_name, 
                     append=True, 
                     ignore_unknown_values=False, 
-                    bq_schema_autodetect=False):
+                    bq_schema_autodetect=False,
+                    staging_bucket=None,
+                    wait=True,
+                    source_format=None):
         """
-        Write file at file_name to table in BQ.
+        Write file at file_name to table in BQ. file_name can also be a gs:// URI,
+        or a list of local files and URIs, which are loaded in a single load job
+        with one merged schema. When loading several files, local ones are first
+        staged in staging_bucket (the bucket named after the dataset by default)
+        and removed once the load is done.
+
+        Files are loaded as NDJSON, or as PARQUET or AVRO if they end in .parquet
+        or .avro or source_format says so. Parquet and Avro files carry their own
+        schema (see write_to_columnar), which is added to the table's when
+        appending.
+
+        If wait is False, the load job is returned as soon as it is started and
+        tracked by the popeline; call wait_all to wait for every load and raise
+        any errors together.
         """
         table_name = table_name.lower().replace("-","_")
-        self.log.info(f"Writing {table_name} to BQ from file {file_name}")
+        sources = [file_name] if isinstance(file_name, str) else list(file_name)
+        self.log.info(f"Writing {table_name} to BQ from {', '.join(sources)}")
         dataset_ref = self.bq_client.dataset(self.dataset_id)
         table_ref = dataset_ref.table(table_name)
 
-        job_config = bigquery.LoadJobConfig()
-        job_config.source_format = 'NEWLINE_DELIMITED_JSON'
+        if source_format is None:
+            formats = {get_source_format(source) for source in sources}
+            if len(formats) > 1:
+                raise ValueError(f"Can't load a mix of {', '.join(sorted(formats))} files in one job")
+            source_format = formats.pop()
 
-        if bq_schema_autodetect == False:
+        job_config = bigquery.LoadJobConfig()
+        job_config.source_format = source_format.upper()
+
+        new_schm = None
+        if job_config.source_format in COLUMNAR_FORMATS:
+            # the schema comes from the files themselves
+            if job_config.source_format == 'AVRO':
+                job_config.use_avro_logical_types = True
+            else:
+                parquet_options = bigquery.ParquetOptions()
+                parquet_options.enable_list_inference = True
+                job_config.parquet_options = parquet_options
+        elif bq_schema_autodetect == False:
             # prepare for schema manipulation
-            current_tables = [x.table_id for x in self.bq_client.list_tables(dataset_ref)]
-            new_schm = self.generate_bq_schema(file_name)
+            old_schm = self.get_table_schema(table_name)
+            new_schm = []
+            for source in sources:
+                new_schm = self.merge_schemas(new_schm, self.generate_bq_schema(source))
 
             # if table exists, edit schema. otherwise, use new_schm
-            if table_name in current_tables:	
-                table = self.bq_client.get_table(table_ref)	
-                new_schm = self.merge_schemas(table.to_api_repr()['schema']['fields'], new_schm)
+            if old_schm is not None:
+                new_schm = self.merge_schemas(old_schm, new_schm)
 
             # move new_schm into job_config through the api_repr options
             api_repr = job_config.to_api_repr()
@@ -141,149 +294,680 @@ class popeline:
         if ignore_unknown_values:
             job_config.ignore_unknown_values = True
 
+        def finish(job, succeeded):
+            for blob in staged_blobs:
+                blob.delete()
+
+            if job is not None:
+                self.record_job('load_job', job, table=table_name)
+
+            # the table now has the schema we loaded with
+            if succeeded and new_schm is not None:
+                self.table_schemas[table_name] = (copy.deepcopy(new_schm), time.time())
+            else:
+                self.invalidate_schema_cache(table_name)
+
+            if succeeded:
+                self.record_watermarks(table_name, sources, append)
+
+        if not wait:
+            self.jobs.wait_for_slot()
+
         # send to BQ
-        with open(file_name, 'rb') as source_file:
-            job = self.bq_client.load_table_from_file(
-                source_file,
-                table_ref,
-                job_config=job_config)  # API request
-            
+        staged_blobs = []
+        try:
+            if len(sources) == 1 and not sources[0].startswith('gs://'):
+                with open(sources[0], 'rb') as source_file:
+                    job = self.bq_client.load_table_from_file(
+                        source_file,
+                        table_ref,
+                        job_config=job_config)  # API request
+            else:
+                uris, staged_blobs = self.stage_in_gcs(sources, staging_bucket)
+                job = self.bq_client.load_table_from_uri(
+                    uris,
+                    table_ref,
+                    job_config=job_config)  # API request
+        except:
+            finish(None, False)
+            raise
+
+        if not wait:
+            return self.jobs.add(job, table_name, on_done=finish)
+
         try:
             job.result()  # Waits for table load to complete.
         except: 
             self.log.info(job.errors)
+            finish(job, False)
             job.result()
 
-    def write_to_gcs(self, gcs_path, file_name, bucket_name=None):
-        self.log.info('Uploading to GCS...')
+        finish(job, True)
+        return job
 
-        if bucket_name:
-            bucket = self.gcs_client.get_bucket(bucket_name)
+    def record_job(self, stage, job, **labels):
+        """
+        Sends the stats BigQuery keeps about a finished job to the metrics sinks.
+        """
+        if not self.metrics.enabled:
+            return
+        seconds = (job.ended - job.started).total_seconds() if job.started and job.ended else None
+        fields = {'job_id': job.job_id, 'seconds': seconds}
+        if job.error_result:
+            fields['error'] = str(job.errors or job.error_result)
+        if stage == 'load_job':
+            fields.update(rows=job.output_rows, bytes=job.input_file_bytes)
         else:
-            bucket = self.gcs_client.get_bucket(self.dataset_id)
+            fields.update(bytes_processed=job.total_bytes_processed, bytes_billed=job.total_bytes_billed)
+        self.metrics.record(stage, **labels, **fields)
+
+    def wait_all(self):
+        """
+        Waits for every job started with wait=False to finish, then raises a
+        popelines.jobs.JobError listing the errors of every job that failed.
+        """
+        self.jobs.wait_all()
+
+    def stage_in_gcs(self, sources, bucket_name=None, max_workers=8):
+        """
+        Uploads the local files in sources to a unique prefix in bucket_name (or
+        the bucket named after the dataset), leaving gs:// URIs as they are.
+        Returns the list of URIs to load and the list of blobs uploaded.
+        """
+        bucket_name = bucket_name or self.dataset_id
+        prefix = f'popelines_staging/{uuid.uuid4().hex}'
+
+        uploads = {}
+        uris = []
+        for count, source in enumerate(sources):
+            if source.startswith('gs://'):
+                uris.append(source)
+                continue
+            gcs_path = f'{prefix}/{count:05d}_{os.path.basename(source)}'
+            uploads[gcs_path] = source
+            uris.append(f'gs://{bucket_name}/{gcs_path}')
+
+        staged_uris = self.write_many_to_gcs(uploads, bucket_name=bucket_name, max_workers=max_workers)
+        return uris, [self.get_gcs_blob(uri) for uri in staged_uris]
+
+    def get_bucket(self, bucket_name=None):
+        """
+        Returns the bucket named bucket_name, or named after the dataset if no
+        bucket_name is given. Buckets are only looked up once.
+        """
+        bucket_name = bucket_name or self.dataset_id
+        if bucket_name not in self.buckets:
+            self.buckets[bucket_name] = self.gcs_client.get_bucket(bucket_name)
+        return self.buckets[bucket_name]
+
+    def write_to_gcs(self,
+                     gcs_path,
+                     file_name,
+                     bucket_name=None,
+                     chunk_size=CHUNK_SIZE,
+                     parallel_parts=None):
+        """
+        Streams the file at file_name to gcs_path in bucket_name (the bucket named
+        after the dataset by default) in chunk_size pieces, a multiple of 256 KiB,
+        with the storage client's resumable upload. Set parallel_parts to upload
+        large files as up to that many pieces at once. Uploads are CRC32C checked.
+        Returns the gs:// URI.
+        """
+        check_chunk_size(chunk_size)
+        self.log.info('Uploading to GCS...')
 
-        blob = storage.Blob(gcs_path, bucket)
-        blob.upload_from_string(open(file_name, 'r').read())
+        bucket = self.get_bucket(bucket_name)
+        uri = f'gs://{bucket.name}/{gcs_path}'
+        size = os.path.getsize(file_name)
+
+        with self.metrics.stage('write_to_gcs', uri=uri) as stage:
+            if parallel_parts and size > chunk_size:
+                parallel_upload(bucket.blob(gcs_path), file_name, parts=parallel_parts, min_part_size=chunk_size)
+            else:
+                resumable_upload(bucket.blob(gcs_path), file_name, chunk_size=chunk_size)
+            stage.add(bytes=size)
+
+        # write_to_bq can reuse the schema built when the file was written
+        if file_name in self.file_schemas:
+            self.file_schemas[uri] = self.file_schemas[file_name]
+        if file_name in self.file_watermarks:
+            self.file_watermarks[uri] = self.file_watermarks[file_name]
+        return uri
+
+    def write_many_to_gcs(self, files, bucket_name=None, max_workers=8, **kwargs):
+        """
+        Provide a dict of gcs_path: file_name and I will upload up to max_workers
+        files at once with write_to_gcs. kwargs are passed to write_to_gcs.
+        Returns the list of gs:// URIs, in the same order as files.
+        """
+        # look the bucket up once, before the threads start
+        self.get_bucket(bucket_name)
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [executor.submit(self.write_to_gcs, gcs_path, file_name, bucket_name, **kwargs)
+                       for gcs_path, file_name in files.items()]
+            return [future.result() for future in futures]
+
+    def write_directory_to_gcs(self, directory, gcs_prefix='', bucket_name=None, max_workers=8, **kwargs):
+        """
+        Uploads every file under directory to gcs_prefix, keeping their paths
+        relative to directory, up to max_workers files at once.
+        """
+        files = {}
+        for root, _, file_names in os.walk(directory):
+            for name in file_names:
+                file_name = os.path.join(root, name)
+                relative = os.path.relpath(file_name, directory).replace(os.sep, '/')
+                files[f'{gcs_prefix.rstrip("/")}/{relative}'.lstrip('/')] = file_name
+
+        return self.write_many_to_gcs(files, bucket_name=bucket_name, max_workers=max_workers, **kwargs)
+
+    def write_to_json(self,
+                      file_name,
+                      jayson,
+                      mode='w',
+                      prep_for_BQ=False,
+                      compress=False,
+                      max_file_bytes=None,
+                      max_file_rows=None,
+                      buffer_size=1024 * 1024,
+                      watermark_columns=None):
+        """
+        Provide a file_name and a list, iterator or generator of dicts and I will
+        write them in line-delimited JSON, one record at a time. Set compress to
+        gzip the output, and max_file_bytes (uncompressed) or max_file_rows to
+        rotate to file_name_00001.json, file_name_00002.json, etc. Appending
+        with rotation carries on from the last of those that exists. Returns the
+        list of files written.
+
+        The maximum of each of watermark_columns is tracked as the records are
+        written, and recorded as the table's watermark when write_to_bq loads
+        the file.
+        """
+        # keep building the schema of this file as we write it. if we're
+        # appending to a file we haven't seen, we can't know its schema.
+        if mode == 'w':
+            builder = self.file_schemas[file_name] = SchemaBuilder()
+        elif file_name in self.file_schemas or not os.path.exists(file_name):
+            builder = self.file_schemas.setdefault(file_name, SchemaBuilder())
+        else:
+            builder = None
 
-    def write_to_json(self, file_name, jayson, mode='w', prep_for_BQ=False):
+        if watermark_columns:
+            tracker = WatermarkTracker(watermark_columns, log=self.log)
+            # appending to a file keeps the maxima we've already seen
+            if mode != 'w' and file_name in self.file_watermarks:
+                tracker.values.update(self.file_watermarks[file_name].values)
+        else:
+            tracker = None
+
+        with self.metrics.stage('write_to_json', file_name=file_name) as stage:
+            with JsonWriter(file_name,
+                            mode=mode,
+                            compress=compress,
+                            max_file_bytes=max_file_bytes,
+                            max_file_rows=max_file_rows,
+                            buffer_size=buffer_size) as writer:
+                for line in jayson:
+                    if prep_for_BQ == True:
+                        line = self.fix_json_keys(line, self.prep_json_for_BQ_callback)
+                    writer.write(line)
+                    if builder is not None and isinstance(line, dict):
+                        builder.add(line)
+                    if tracker is not None and isinstance(line, dict):
+                        tracker.observe(line)
+            stage.add(rows=writer.row_count, bytes=writer.byte_count, files=len(writer.file_names))
+
+        # rotated files share the schema of the whole write
+        for name in writer.file_names:
+            if name == file_name:
+                continue
+            if builder is not None:
+                self.file_schemas[name] = builder
+            else:
+                self.file_schemas.pop(name, None)
+
+        for name in writer.file_names:
+            if tracker is not None:
+                self.file_watermarks[name] = tracker
+            else:
+                self.file_watermarks.pop(name, None)
+
+        return writer.file_names
+
+    def write_to_columnar(self,
+                          file_name,
+                          records,
+                          fields,
+                          format=None,
+                          prep_for_BQ=False,
+                          batch_size=10000,
+                          compression=None,
+                          watermark_columns=None):
         """
-        Provide a table_name and a dict object and I will write it in line-delimited
-        JSON.
+        Write a list, iterator or generator of dicts to a Parquet or Avro file,
+        going by file_name's extension unless format is given, with the BQ schema
+        fields. Columns are built batch_size records at a time, so memory stays
+        bounded. Values are converted to the types in fields, and keys that
+        aren't in fields are dropped. Returns file_name, ready for write_to_bq.
+
+        Parquet needs pyarrow and Avro needs fastavro.
         """
-        if prep_for_BQ == True:
-            jayson = self.fix_json_keys(jayson, self.prep_json_for_BQ_callback)
+        tracker = WatermarkTracker(watermark_columns, log=self.log) if watermark_columns else None
+
+        with self.metrics.stage('write_to_columnar', file_name=file_name) as stage:
+            with ColumnarWriter(file_name,
+                                fields,
+                                format=format,
+                                batch_size=batch_size,
+                                compression=compression) as writer:
+                for record in records:
+                    if prep_for_BQ == True:
+                        record = self.fix_json_keys(record, self.prep_json_for_BQ_callback)
+                    writer.write(record)
+                    if tracker is not None:
+                        tracker.observe(record)
+            stage.add(rows=writer.row_count, bytes=writer.byte_count)
+
+        if tracker is not None:
+            self.file_watermarks[file_name] = tracker
+        else:
+            self.file_watermarks.pop(file_name, None)
+
+        return file_name
 
-        with open(file_name, mode) as f:
-            for line in jayson:
-                f.writelines(json.dumps(line) + '\n')
+    def convert_json_to_columnar(self,
+                                 json_file,
+                                 file_name=None,
+                                 format='parquet',
+                                 table_name=None,
+                                 batch_size=10000,
+                                 compression=None):
+        """
+        Rewrite the NDJSON file json_file as Parquet or Avro, at file_name or
+        next to json_file (data.json -> data.parquet). The schema is the one
+        write_to_json built for json_file (or one inferred from it), merged with
+        the schema of table_name if that table exists, so that the file's
+        columns line up with the table's. Returns the new file name.
+        """
+        fields = self.generate_bq_schema(json_file)
+        if table_name:
+            old_schm = self.get_table_schema(table_name.lower().replace("-","_"))
+            if old_schm is not None:
+                fields = self.merge_schemas(old_schm, fields)
+
+        file_name = file_name or columnar_file_name(json_file, format)
+        with open_ndjson(json_file) as f:
+            records = (json.loads(line) for line in f if line.strip())
+            self.write_to_columnar(file_name,
+                                   records,
+                                   fields,
+                                   format=format,
+                                   batch_size=batch_size,
+                                   compression=compression)
+
+        # the watermarks tracked while writing the JSON still apply
+        if json_file in self.file_watermarks:
+            self.file_watermarks[file_name] = self.file_watermarks[json_file]
+
+        return file_name
 
     def prep_json_for_BQ_callback(self, key):
         """
         Callback function used for write_to_json's fix_keys call
         """
-        # add _ if first character in key is numeric
-        if key[0].isnumeric():
-            key = "_" + key
-        # replace "." or " " with "_"
-        key = re.sub(r"[. ]","_",key)
-        # replace non-alphanumeric, non-"_" characters with nothing
-        key = re.sub(r"[^a-zA-Z0-9_]","",key)
-        return key
-
-    def call_api(self, url, method='GET', headers=None, params=None, data=None):
+        return prep_key_for_BQ(key)
+
+    def configure_api(self,
+                      pool_size=10,
+                      max_retries=3,
+                      backoff_factor=0.5,
+                      rate_limit=None,
+                      timeout=None,
+                      retry_methods=()):
+        """
+        Replaces the HTTP client used by call_api. Responses with status 429 or
+        5xx are retried up to max_retries times with exponential backoff, and
+        rate_limit caps the number of requests per second. Only idempotent
+        requests (GET, PUT, DELETE...) are retried, unless their method is in
+        retry_methods, e.g. ['POST'] for endpoints that are safe to repeat.
+        """
+        self.api_client.close()
+        self.api_client = ApiClient(pool_size=pool_size,
+                                    max_retries=max_retries,
+                                    backoff_factor=backoff_factor,
+                                    rate_limit=rate_limit,
+                                    timeout=timeout,
+                                    retry_methods=retry_methods)
+
+    def call_api(self, url, method='GET', headers=None, params=None, data=None, raise_errors=False):
         """
         Provide an endpoint and a method ('GET', 'POST', etc.), along with other arguments.
-        Headers and params must be in dict form. Returns JSON.
+        Headers and params must be in dict form. Returns JSON. Connections are pooled
+        and failed requests retried; if the response still isn't JSON, the error is
+        logged and None returned, unless raise_errors is set.
         """
-        r = requests.request(method=method, url=url, headers=headers, params=params, data=data)
+        with self.metrics.stage('call_api', url=url, method=method) as stage:
+            r = self.api_client.request(method, url, headers=headers, params=params, data=data)
+            retries = getattr(getattr(r.raw, 'retries', None), 'history', ())
+            stage.add(bytes=len(r.content), retries=len(retries), status=r.status_code)
         
         self.log.debug(f'Called endpoint {url} with result {r}')
 
+        if raise_errors:
+            r.raise_for_status()
+            return r.json()
+
         try:
             jayson = json.loads(r.text)
             return jayson
         except:
             self.log.info(f'ERROR! Text of response object: {r.text}')
 
+    def call_api_many(self, calls, max_workers=8, raise_errors=False):
+        """
+        Provide a list of dicts of call_api arguments (url, method, headers, params,
+        data) and I will make up to max_workers calls at once. Returns a list of
+        results in the same order as calls.
+        """
+        calls = [dict(call, raise_errors=raise_errors) for call in calls]
+        return self.api_client.map(self.call_api, calls, max_workers=max_workers)
+
+    def paginate_api(self, url, pagination='cursor', **kwargs):
+        """
+        Returns an iterator over the records of every page of a paginated endpoint,
+        fetching pages lazily (and the next one ahead of time). pagination is 'cursor',
+        'offset' or 'link'; see popelines.pagination.Paginator for the other arguments.
+        """
+        return Paginator(self.api_client, url, pagination=pagination, metrics=self.metrics, **kwargs)
+
+    def api_to_json(self,
+                    file_name,
+                    url,
+                    pagination='cursor',
+                    prep_for_BQ=False,
+                    compress=False,
+                    max_file_bytes=None,
+                    max_file_rows=None,
+                    **kwargs):
+        """
+        Streams every record of a paginated endpoint into line-delimited JSON at
+        file_name, so only a page or two is in memory at once. kwargs are passed
+        to paginate_api. Returns the list of files written.
+        """
+        self.log.info(f'Writing {url} to {file_name}')
+        records = self.paginate_api(url, pagination=pagination, **kwargs)
+        return self.write_to_json(file_name,
+                                  records,
+                                  prep_for_BQ=prep_for_BQ,
+                                  compress=compress,
+                                  max_file_bytes=max_file_bytes,
+                                  max_file_rows=max_file_rows)
+
     def chunk_date_range(self, start_datetime, end_datetime, chunk_size):
         """
         Takes start and end datetimes and chunks the period into n-days
         size chunks.
         """
         self.log.info(f'Chunking period {start_datetime} to {end_datetime} into chunks of {chunk_size} days.')
-        for n in range(int ((end_datetime - start_datetime).days) + 1):
-            if n/chunk_size == int(n/chunk_size):
-                start = start_datetime + datetime.timedelta(n)
-                end = start_datetime + datetime.timedelta(n+chunk_size)
-                
-                # if we reach the end_datetime, return that instead of end
-                if end < end_datetime:
-                    yield (start, end)
-                else:
-                    yield (start, end_datetime)
-
-    def find_last_entry(self, table_name, date_column):
-        """
-        Returns maximum value from date_column in table_name.
-        """
-        query = f"SELECT MAX({date_column}) FROM `{self.dataset_id}.{table_name}`"
+        for n in range(0, int((end_datetime - start_datetime).days) + 1, chunk_size):
+            start = start_datetime + datetime.timedelta(n)
+            end = start_datetime + datetime.timedelta(n+chunk_size)
+
+            # if we reach the end_datetime, return that instead of end
+            if end < end_datetime:
+                yield (start, end)
+            else:
+                yield (start, end_datetime)
+
+    def backfill(self,
+                 func,
+                 start_datetime,
+                 end_datetime,
+                 chunk_size,
+                 max_workers=4,
+                 checkpoint_file=None,
+                 retries=2,
+                 retry_delay=5,
+                 name=None):
+        """
+        Splits the period into chunks with chunk_date_range and calls func(start, end)
+        for each chunk on max_workers threads. Each completed chunk is recorded in
+        checkpoint_file, so running the same backfill again skips it. Failed chunks
+        are retried on their own up to retries times; if any still fail, a
+        popelines.backfill.BackfillError is raised once the rest are done.
+        Returns a dict of (start, end) to whatever func returned.
+
+        Without checkpoint_file, the checkpoint is named after the dataset, the
+        period and name, which says what work is being backfilled (e.g. the
+        table it loads). name can only be left out when func is a plain
+        module-level function, since lambdas, partials and closures don't say
+        what they do with their chunks.
+        """
+        if not checkpoint_file:
+            if name is None:
+                if (not isinstance(func, types.FunctionType)
+                        or func.__name__ == '<lambda>'
+                        or func.__closure__
+                        or '<locals>' in func.__qualname__):
+                    raise ValueError('backfill needs a name or checkpoint_file to tell apart '
+                                     f'the work done by {func!r} from other backfills')
+                name = f'{func.__module__}.{func.__qualname__}'
+            checkpoint_file = (f'{self.directory}/.popelines_backfill_{self.dataset_id}_{name}_'
+                               f'{start_datetime:%Y%m%d}_{end_datetime:%Y%m%d}_{chunk_size}.json')
+
+        return run_backfill(self.chunk_date_range(start_datetime, end_datetime, chunk_size),
+                            func,
+                            max_workers=max_workers,
+                            checkpoint=Checkpoint(checkpoint_file),
+                            retries=retries,
+                            retry_delay=retry_delay,
+                            log=self.log)
+
+    def watermark_key(self, table_name, column=''):
+        table_name = table_name.lower().replace("-","_")
+        return f'{self.dataset_id}.{table_name}.{column}'
+
+    def get_watermark(self, table_name, column):
+        """
+        Returns the recorded high-water mark of column in table_name, or None.
+        """
+        return self.watermarks.get(self.watermark_key(table_name, column))
+
+    def set_watermark(self, table_name, column, value):
+        self.watermarks.set(self.watermark_key(table_name, column), value)
+
+    def use_watermark_table(self, table_name='_popelines_watermarks'):
+        """
+        Keep watermarks in a small table in the dataset instead of a local file,
+        so that jobs on different machines share them.
+        """
+        table_id = f'{self.bq_client.project}.{self.dataset_id}.{table_name}'
+        self.watermarks = TableWatermarkStore(self.bq_client, table_id)
+
+    def record_watermarks(self, table_name, sources, append=True):
+        """
+        Records the watermarks write_to_json tracked for sources against
+        table_name. Appends only ever move a watermark forward. Watermarks of
+        any other columns of table_name are forgotten, since this load may
+        have moved them without us knowing.
+        """
+        maxima = {}
+        for source in sources:
+            tracker = self.file_watermarks.get(source)
+            if tracker:
+                for column, value in tracker.values.items():
+                    maxima[column] = later(maxima.get(column), value)
+
+        for column, value in maxima.items():
+            if append:
+                value = later(self.get_watermark(table_name, column), value)
+            self.log.debug(f'Watermark of {table_name}.{column} is now {value}')
+            self.set_watermark(table_name, column, value)
+
+        keep = [self.watermark_key(table_name, column) for column in maxima]
+        self.watermarks.clear(self.watermark_key(table_name), keep=keep)
+
+    def find_last_entry(self, table_name, date_column, use_watermark=False):
+        """
+        Returns maximum value from date_column in table_name. With
+        use_watermark, if write_to_bq recorded a watermark for the column from
+        write_to_json's watermark_columns, that is returned without running a
+        query. Otherwise, if the table is partitioned on date_column only the
+        latest partition is scanned; failing that, the whole column is.
+        """
+        if use_watermark:
+            latest_time = self.get_watermark(table_name, date_column)
+            if latest_time is not None:
+                return latest_time
+
+        query = self.latest_partition_query(table_name, date_column)
+        if not query:
+            query = f"SELECT MAX({date_column}) FROM `{self.dataset_id}.{table_name}`"
         query_job = self.bq_client.query(query)  # API request
         rows = query_job.result()
         latest_time = [x[0] for x in rows][0]
 
         return latest_time
 
-    def bq_query(self, query):
+    def latest_partition_query(self, table_name, date_column):
         """
-        Runs a query in BQ and retunrs the results in a list of rows.
+        If table_name is partitioned on date_column, returns a query for the
+        MAX of date_column that only scans the latest partition. Otherwise
+        returns None.
         """
-        query_job = self.bq_client.query(query)  # API request
-        rows = [x for x in query_job.result()]
+        table = self.bq_client.get_table(self.bq_client.dataset(self.dataset_id).table(table_name))
+        partitioning = table.time_partitioning
+        if not partitioning or partitioning.field != date_column:
+            return None
+
+        partitions = (f"SELECT MAX(partition_id) FROM `{table.project}.{self.dataset_id}.INFORMATION_SCHEMA.PARTITIONS` "
+                      f"WHERE table_name = '{table.table_id}' AND total_rows > 0 "
+                      f"AND partition_id NOT IN ('__NULL__', '__UNPARTITIONED__')")
+        partition_id = [x[0] for x in self.bq_client.query(partitions).result()][0]
+        if not partition_id:
+            return None
+
+        formats = {'HOUR': '%Y%m%d%H', 'DAY': '%Y%m%d', 'MONTH': '%Y%m', 'YEAR': '%Y'}
+        start = datetime.datetime.strptime(partition_id, formats[partitioning.type_ or 'DAY'])
+        field_type = {field.name: field.field_type for field in table.schema}[date_column]
+        if field_type == 'DATE':
+            literal = f"DATE '{start:%Y-%m-%d}'"
+        else:
+            literal = f"{field_type} '{start:%Y-%m-%d %H:%M:%S}'"
+
+        return f"SELECT MAX({date_column}) FROM `{self.dataset_id}.{table_name}` WHERE {date_column} >= {literal}"
+
+    def bq_query(self, query, use_cache=False, cache_ttl=None):
+        """
+        Runs a query in BQ and retunrs the results in a list of rows. If use_cache
+        is set, results are kept on disk by query text and reused for cache_ttl
+        seconds (an hour by default).
+        """
+        if use_cache:
+            cached = self.query_cache.get(query, cache_ttl, project=self.bq_client.project)
+            if cached is not None:
+                self.log.debug('Using cached query results')
+                field_to_index, values = cached
+                return [bigquery.table.Row(row, field_to_index) for row in values]
+
+        with self.metrics.stage('bq_query') as stage:
+            query_job = self.bq_client.query(query)  # API request
+            result = query_job.result()
+            rows = [x for x in result]
+            stage.add(rows=len(rows),
+                      job_id=query_job.job_id,
+                      bytes_processed=query_job.total_bytes_processed,
+                      bytes_billed=query_job.total_bytes_billed)
+
+        if use_cache:
+            field_to_index = {field.name: count for count, field in enumerate(result.schema)}
+            self.query_cache.set(query, field_to_index, [row.values() for row in rows], project=self.bq_client.project)
         
         return rows
 
-    def fix_json_keys(self, obj, callback):
+    def iter_bq_query(self, query, page_size=None):
+        """
+        Runs a query in BQ and yields its rows one at a time, fetching a page
+        of page_size rows at a time as they're needed.
+        """
+        query_job = self.bq_client.query(query)  # API request
+        result = query_job.result(page_size=page_size)
+        self.record_job('bq_query', query_job, rows=result.total_rows)
+        yield from result
+
+    def bq_query_batches(self, query, format='arrow', page_size=None):
+        """
+        Runs a query in BQ and yields its results a batch at a time, either as
+        pyarrow RecordBatches (format='arrow', needs pyarrow) or as dicts of
+        column name to list of values (format='columns').
+        """
+        query_job = self.bq_client.query(query)  # API request
+        result = query_job.result(page_size=page_size)
+        self.record_job('bq_query', query_job, rows=result.total_rows)
+
+        if format == 'arrow':
+            yield from result.to_arrow_iterable()
+        elif format == 'columns':
+            field_names = [field.name for field in result.schema]
+            for page in result.pages:
+                yield rows_to_columns(page, field_names)
+        else:
+            raise ValueError(f"format must be 'arrow' or 'columns', not {format}")
+
+    def bq_query_to_json(self,
+                         query,
+                         file_name,
+                         compress=False,
+                         max_file_bytes=None,
+                         max_file_rows=None,
+                         page_size=None):
+        """
+        Runs a query in BQ and streams its results into line-delimited JSON at
+        file_name, a page at a time. Returns the list of files written.
+        """
+        rows = (row_to_json(row) for row in self.iter_bq_query(query, page_size=page_size))
+        return self.write_to_json(file_name,
+                                  rows,
+                                  compress=compress,
+                                  max_file_bytes=max_file_bytes,
+                                  max_file_rows=max_file_rows)
+
+    def fix_json_keys(self, obj, callback, in_place=False):
         """
         Runs all keys in a JSON object (dict or list) through 
-        the given callback function.
-        """
-        if type(obj) == list:
-            newlist = []
-            for item in obj:
-                newlist.append(self.fix_json_keys(item, callback))
-            return newlist
-        elif type(obj) == dict:
-            newdict = {}
-            for item in list(obj):
-                if type(obj[item]) == list or type(obj[item]) == dict:
-                    newdict[callback(item)] = self.fix_json_keys(obj[item], callback)
-                else:
-                    newdict[callback(item)] = obj[item]
-            return newdict
-
-    def fix_json_values(self, obj, callback, **kwargs):
+        the given callback function. The callback's results are cached,
+        so it should depend on nothing but the key. Set in_place to
+        modify obj instead of building a copy.
+        """
+        return fix_keys(obj, self.cached_key_callback(callback), in_place)
+
+    def cached_key_callback(self, callback):
+        """
+        Returns callback wrapped in a bounded LRU cache, reusing the
+        same cache for every call with the same callback.
+        """
+        # prep_key_for_BQ has its own cache, unless a subclass overrides the callback
+        if getattr(callback, '__func__', None) is popeline.prep_json_for_BQ_callback:
+            return prep_key_for_BQ
+
+        cached = self.key_callbacks.get(callback)
+        if cached is None:
+            # don't let one-off lambdas pile up
+            if len(self.key_callbacks) >= 32:
+                self.key_callbacks.clear()
+            cached = self.key_callbacks[callback] = cache_callback(callback)
+        return cached
+
+    def fix_json_values(self, obj, callback, in_place=False, **kwargs):
         """
         Runs all values in a JSON object (dict or list) through 
         the given callback function. Callback should be passed two
-        arguments, the value of the key:value pair (`obj[item]` below)
-        and the key (`item` below). **kwargs allows you to add arbitrary
-        keywords to pass to your callback function.
-        """
-        if type(obj) == list:
-            newlist = []
-            for item in obj:
-                newlist.append(self.fix_json_values(item, callback, **kwargs))
-            return newlist
-        elif type(obj) == dict:
-            newdict = {}
-            for item in list(obj):
-                if type(obj[item]) == list or type(obj[item]) == dict:
-                    newdict[item] = self.fix_json_values(callback(obj[item], item, **kwargs), callback, **kwargs)
-                else:
-                    newdict[item] = callback(obj[item], item, **kwargs)
-            return newdict
-        else:
-            return obj
+        arguments, the value of the key:value pair and the key.
+        **kwargs allows you to add arbitrary keywords to pass to your
+        callback function. Set in_place to modify obj instead of
+        building a copy.
+        """
+        return fix_values(obj, callback, in_place, **kwargs)
 
     def copy_and_replace_keys(self, table, key_callback):
         """
@@ -293,18 +977,44 @@ class popeline:
         client = self.bq_client
         t = client.get_table(table)
 
-        cross_joins = []
-
-        # begin query generation process
-        q = f'CREATE OR REPLACE TABLE `{table}` AS (\nSELECT \n'
-        for field in t.schema:
-            q += process_field(field, None, key_callback)
-            cross_joins.extend(process_cross_joins(field, "copy_table"))
-        q = q.strip(",\n")
-        q += f"\nFROM\n  `{table}` copy_table"
+        return build_copy_query(table, t.schema, key_callback)
 
-        for cross_join in cross_joins:
-            q += cross_join
-        q += ")"
-
-        return q
\ No newline at end of file
+    def copy_and_replace_keys_bulk(self,
+                                   key_callback,
+                                   tables=None,
+                                   dataset_id=None,
+                                   max_workers=8,
+                                   execute=True):
+        """
+        Generates copy_and_replace_keys queries for every table in tables (full
+        table ids), or every table in dataset_id (the popeline's dataset by
+        default). Tables whose column names the callback leaves unchanged are
+        skipped. If execute is set, the queries are run with at most max_workers
+        at once, and a popelines.jobs.JobError lists any that failed. Returns a
+        dict of table to query.
+        """
+        client = self.bq_client
+        if tables is None:
+            dataset_id = dataset_id or self.dataset_id
+            tables = [f'{t.project}.{t.dataset_id}.{t.table_id}'
+                      for t in client.list_tables(dataset_id) if t.table_type == 'TABLE']
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            schemas = dict(zip(tables, executor.map(lambda table: client.get_table(table).schema, tables)))
+
+        queries = {}
+        for table, schema in schemas.items():
+            if keys_unchanged(schema, key_callback):
+                self.log.debug(f'Skipping {table}, its keys are already fixed')
+            else:
+                queries[table] = build_copy_query(table, schema, key_callback)
+        self.log.info(f'Rewriting keys of {len(queries)} of {len(schemas)} tables')
+
+        if execute:
+            jobs = JobManager(max_in_flight=max_workers, log=self.log)
+            for table, query in queries.items():
+                jobs.wait_for_slot()
+                jobs.add(client.query(query), table)
+            jobs.wait_all()
+
+        return queries
@@ -0,0 +1,181 @@
+import io
+import json
+import logging
+import os
+import threading
+import time
+
+# fields every stage record can carry, and the Prometheus counters they feed
+COUNTERS = {
+    'seconds': 'popelines_stage_seconds_total',
+    'rows': 'popelines_stage_rows_total',
+    'bytes': 'popelines_stage_bytes_total',
+    'retries': 'popelines_stage_retries_total',
+    'bytes_processed': 'popelines_bq_bytes_processed_total',
+    'bytes_billed': 'popelines_bq_bytes_billed_total',
+}
+
+
+class Stage:
+    """
+    One timed run of a pipeline stage. Code inside the stage adds what it
+    knows about the work with add().
+    """
+    def __init__(self, metrics, name, labels):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+        self.fields = {}
+        self.profiler = None
+        if metrics.profile:
+            # only loaded when asked for, pstats is slow to import
+            import cProfile
+            self.profiler = cProfile.Profile()
+
+    def add(self, **fields):
+        for key, value in fields.items():
+            if value is not None:
+                self.fields[key] = self.fields.get(key, 0) + value if key in COUNTERS else value
+
+    def __enter__(self):
+        self.started = time.time()
+        self.start = time.perf_counter()
+        if self.profiler:
+            try:
+                self.profiler.enable()
+            except ValueError:
+                # another stage is already being profiled on this thread
+                self.profiler = None
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        seconds = time.perf_counter() - self.start
+        if self.profiler:
+            self.profiler.disable()
+            import pstats
+            out = io.StringIO()
+            pstats.Stats(self.profiler, stream=out).sort_stats('cumulative').print_stats(15)
+            self.fields['profile'] = out.getvalue()
+        if exc is not None:
+            self.fields['error'] = repr(exc)
+        self.metrics.emit(self.name, self.labels, dict(self.fields, seconds=seconds), self.started)
+        return False
+
+
+class NullStage:
+    """
+    Stands in for a Stage when metrics are off, so instrumented code costs
+    next to nothing.
+    """
+    def add(self, **fields):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+NULL_STAGE = NullStage()
+
+
+class Metrics:
+    """
+    Times pipeline stages and sends a record of each to every sink. Does
+    nothing until a sink is added. With profile set, each stage also runs
+    under cProfile and its top functions are added to the record.
+    """
+    def __init__(self, sinks=None, profile=False):
+        self.sinks = list(sinks or [])
+        self.profile = profile
+
+    @property
+    def enabled(self):
+        return bool(self.sinks)
+
+    def add_sink(self, sink):
+        self.sinks.append(sink)
+
+    def stage(self, name, **labels):
+        if not self.sinks:
+            return NULL_STAGE
+        return Stage(self, name, labels)
+
+    def record(self, name, **fields):
+        """
+        Sends a record for work that was timed elsewhere, e.g. by BigQuery.
+        """
+        if self.sinks:
+            self.emit(name, {}, {k: v for k, v in fields.items() if v is not None}, time.time())
+
+    def emit(self, name, labels, fields, started):
+        record = {'stage': name, 'started_at': started, **labels, **fields}
+        for sink in self.sinks:
+            sink(record)
+
+
+class JsonLogSink:
+    """
+    Logs each record as a line of JSON, to a logger or appended to a file.
+    """
+    def __init__(self, log=None, file_name=None, level=logging.INFO):
+        self.log = log or logging.getLogger('popelines.metrics')
+        self.file_name = file_name
+        self.level = level
+        self.lock = threading.Lock()
+
+    def __call__(self, record):
+        line = json.dumps(record, default=str)
+        if self.file_name:
+            with self.lock, open(self.file_name, 'a') as f:
+                f.write(line + '\n')
+        else:
+            self.log.log(self.level, line)
+
+
+class PrometheusTextSink:
+    """
+    Keeps per-stage totals and rewrites them to file_name in the Prometheus
+    text format after every record, for node_exporter's textfile collector.
+    """
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self.totals = {}
+        self.lock = threading.Lock()
+
+    def __call__(self, record):
+        with self.lock:
+            totals = self.totals.setdefault(record['stage'], {'calls': 0, 'errors': 0})
+            totals['calls'] += 1
+            totals['errors'] += 'error' in record
+            for field in COUNTERS:
+                if isinstance(record.get(field), (int, float)):
+                    totals[field] = totals.get(field, 0) + record[field]
+            self.write()
+
+    def write(self):
+        lines = []
+        metrics = dict(COUNTERS, calls='popelines_stage_calls_total', errors='popelines_stage_errors_total')
+        for field, metric in metrics.items():
+            lines.append(f'# TYPE {metric} counter')
+            for stage, totals in sorted(self.totals.items()):
+                if field in totals:
+                    lines.append(f'{metric}{{stage="{stage}"}} {totals[field]}')
+
+        # write to a temp file first so the collector never reads half a file
+        temp_name = f'{self.file_name}.tmp'
+        with open(temp_name, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(temp_name, self.file_name)
+
+
+class CallbackSink:
+    """
+    Passes each record to func.
+    """
+    def __init__(self, func):
+        self.func = func
+
+    def __call__(self, record):
+        self.func(record)
@@ -0,0 +1,174 @@
+import queue
+import threading
+
+from popelines.metrics import Metrics
+
+PAGINATION_TYPES = ('cursor', 'offset', 'link')
+
+# marks the end of the pages in the prefetch queue
+_DONE = object()
+
+
+def get_path(obj, path):
+    """
+    Looks up a dotted path like 'meta.next_cursor' in a JSON object.
+    Returns None if any part of it is missing.
+    """
+    for key in path.split('.'):
+        if not isinstance(obj, dict) or key not in obj:
+            return None
+        obj = obj[key]
+    return obj
+
+
+class Paginator:
+    """
+    Iterates lazily over the records of a paginated API endpoint.
+
+    pagination is one of:
+      'cursor' - the next cursor is read from cursor_path in each response
+                 and sent back as the cursor_param query parameter. A cursor
+                 that is a full URL is requested as is.
+      'offset' - offset_param and limit_param are stepped by page_size until
+                 a page comes back short.
+      'link'   - the next page is the rel="next" URL of the Link header.
+
+    Records are read from records_path in each response, or the response
+    itself if it is a list. If prefetch is set, the next page is fetched on a
+    background thread while the current one is consumed. Each page request is
+    timed as a call_api stage of metrics.
+    """
+    def __init__(self,
+                 client,
+                 url,
+                 pagination='cursor',
+                 method='GET',
+                 headers=None,
+                 params=None,
+                 data=None,
+                 records_path=None,
+                 cursor_path='next_cursor',
+                 cursor_param='cursor',
+                 offset_param='offset',
+                 limit_param='limit',
+                 page_size=100,
+                 max_pages=None,
+                 prefetch=True,
+                 metrics=None):
+        if pagination not in PAGINATION_TYPES:
+            raise ValueError(f'pagination must be one of {PAGINATION_TYPES}, not {pagination}')
+
+        self.client = client
+        self.url = url
+        self.pagination = pagination
+        self.method = method
+        self.headers = headers
+        self.params = dict(params or {})
+        self.data = data
+        self.records_path = records_path
+        self.cursor_path = cursor_path
+        self.cursor_param = cursor_param
+        self.offset_param = offset_param
+        self.limit_param = limit_param
+        self.page_size = page_size
+        self.max_pages = max_pages
+        self.prefetch = prefetch
+        self.metrics = metrics or Metrics()
+
+    def __iter__(self):
+        for page in self.pages():
+            yield from page
+
+    def pages(self):
+        """
+        Yields the list of records on each page.
+        """
+        if self.prefetch:
+            return self._prefetched_pages()
+        return self._fetch_pages()
+
+    def _fetch_pages(self):
+        url = self.url
+        params = dict(self.params)
+        if self.pagination == 'offset':
+            params.setdefault(self.offset_param, 0)
+            params[self.limit_param] = self.page_size
+
+        page_count = 0
+        while url:
+            with self.metrics.stage('call_api', url=url, method=self.method) as stage:
+                r = self.client.request(self.method, url, headers=self.headers, params=params, data=self.data)
+                retries = getattr(getattr(r.raw, 'retries', None), 'history', ())
+                stage.add(bytes=len(r.content), retries=len(retries), status=r.status_code)
+            r.raise_for_status()
+            body = r.json()
+
+            records = get_path(body, self.records_path) if self.records_path else body
+            if records is None:
+                records = []
+            elif not isinstance(records, list):
+                records = [records]
+
+            yield records
+
+            page_count += 1
+            if self.max_pages and page_count >= self.max_pages:
+                return
+            url, params = self._next_request(url, params, r, body, records)
+
+    def _next_request(self, url, params, response, body, records):
+        """
+        Returns the url and params of the next page, or a None url if this
+        was the last page.
+        """
+        if self.pagination == 'cursor':
+            cursor = get_path(body, self.cursor_path) if isinstance(body, dict) else None
+            if not cursor or not records:
+                return None, None
+            if isinstance(cursor, str) and cursor.startswith(('http://', 'https://')):
+                return cursor, None
+            return url, dict(params or {}, **{self.cursor_param: cursor})
+
+        if self.pagination == 'offset':
+            if len(records) < self.page_size:
+                return None, None
+            return url, dict(params, **{self.offset_param: params[self.offset_param] + len(records)})
+
+        # the next link already carries its query string
+        return response.links.get('next', {}).get('url'), None
+
+    def _prefetched_pages(self):
+        pages = queue.Queue(maxsize=1)
+        stop = threading.Event()
+
+        def put(item):
+            # give up if the consumer has stopped reading
+            while not stop.is_set():
+                try:
+                    pages.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def fetch():
+            try:
+                for page in self._fetch_pages():
+                    if not put(page):
+                        return
+                put(_DONE)
+            except Exception as e:
+                put(e)
+
+        thread = threading.Thread(target=fetch, daemon=True)
+        thread.start()
+        try:
+            while True:
+                page = pages.get()
+                if page is _DONE:
+                    return
+                if isinstance(page, Exception):
+                    raise page
+                yield page
+        finally:
+            stop.set()
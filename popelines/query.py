@@ -0,0 +1,105 @@
+import base64
+import datetime
+import decimal
+import hashlib
+import os
+import pickle
+import re
+import time
+
+# string literals, quoted identifiers and comments, which are kept as they
+# are, or a run of whitespace outside them
+token_re = re.compile(r"""
+    ( '''.*?''' | \"\"\".*?\"\"\"
+    | '(?:\\.|[^'\\])*' | "(?:\\.|[^"\\])*" | `(?:\\.|[^`\\])*`
+    | --[^\n]*\n? | \#[^\n]*\n? | /\*.*?\*/ )
+    | (\s+)
+""", re.S | re.X)
+
+
+def normalize_query(query):
+    """
+    Collapses whitespace outside string literals, quoted identifiers and
+    comments, and drops a trailing semicolon, so that queries differing only
+    in formatting share a cache entry.
+    """
+    query = token_re.sub(lambda m: m.group(1) or ' ', query)
+    return query.strip().rstrip(';').strip()
+
+
+def to_json_value(value):
+    """
+    Converts a value from a BQ row into something json.dumps can write and
+    BigQuery can load back.
+    """
+    if isinstance(value, (datetime.datetime, datetime.date, datetime.time)):
+        return value.isoformat()
+    if isinstance(value, decimal.Decimal):
+        return str(value)
+    if isinstance(value, bytes):
+        return base64.b64encode(value).decode()
+    if isinstance(value, dict):
+        return {key: to_json_value(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [to_json_value(item) for item in value]
+    return value
+
+
+def row_to_json(row):
+    return {key: to_json_value(value) for key, value in row.items()}
+
+
+def rows_to_columns(rows, field_names):
+    """
+    Turns a page of rows into a dict of column name to list of values.
+    """
+    columns = {name: [] for name in field_names}
+    for row in rows:
+        for name, value in zip(field_names, row.values()):
+            columns[name].append(value)
+    return columns
+
+
+class QueryCache:
+    """
+    Caches query results on disk, keyed by the hash of the project the query
+    runs in and the normalized query text. Entries older than ttl seconds are
+    ignored.
+    """
+    def __init__(self, directory, ttl=3600):
+        self.directory = directory
+        self.ttl = ttl
+
+    def path(self, query, project=None):
+        key = hashlib.sha256(f'{project}\n{normalize_query(query)}'.encode()).hexdigest()
+        return os.path.join(self.directory, f'{key}.pickle')
+
+    def get(self, query, ttl=None, project=None):
+        """
+        Returns (field_to_index, list of value tuples) for query, or None.
+        """
+        ttl = self.ttl if ttl is None else ttl
+        path = self.path(query, project)
+        try:
+            if ttl is not None and time.time() - os.path.getmtime(path) > ttl:
+                return None
+            with open(path, 'rb') as f:
+                return pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return None
+
+    def set(self, query, field_to_index, values, project=None):
+        os.makedirs(self.directory, exist_ok=True)
+        path = self.path(query, project)
+        # write to a temp file first so readers never see half an entry
+        temp_path = f'{path}.{os.getpid()}.tmp'
+        with open(temp_path, 'wb') as f:
+            pickle.dump((field_to_index, values), f)
+        os.replace(temp_path, path)
+
+    def clear(self):
+        if not os.path.isdir(self.directory):
+            return
+        for name in os.listdir(self.directory):
+            if name.endswith('.pickle'):
+                os.remove(os.path.join(self.directory, name))
@@ -0,0 +1,296 @@
+import json
+import re
+from popelines.writer import open_ndjson
+
+# BigQuery types a value can be upgraded to, given the type already seen
+# for that column. Two string types merge to STRING, anything else conflicts.
+type_upgrades = {
+    ('INTEGER', 'FLOAT'): 'FLOAT',
+    ('FLOAT', 'INTEGER'): 'FLOAT',
+    # quoted numbers and booleans, as bigquery_schema_generator merges them
+    ('QINTEGER', 'QFLOAT'): 'QFLOAT',
+    ('QFLOAT', 'QINTEGER'): 'QFLOAT',
+    ('QINTEGER', 'INTEGER'): 'INTEGER',
+    ('INTEGER', 'QINTEGER'): 'INTEGER',
+    ('QFLOAT', 'FLOAT'): 'FLOAT',
+    ('FLOAT', 'QFLOAT'): 'FLOAT',
+    ('QINTEGER', 'FLOAT'): 'FLOAT',
+    ('FLOAT', 'QINTEGER'): 'FLOAT',
+    ('QFLOAT', 'INTEGER'): 'FLOAT',
+    ('INTEGER', 'QFLOAT'): 'FLOAT',
+    ('QBOOLEAN', 'BOOLEAN'): 'BOOLEAN',
+    ('BOOLEAN', 'QBOOLEAN'): 'BOOLEAN',
+}
+
+# types that are read out of JSON strings, so can always be merged as STRING
+string_types = frozenset(['STRING', 'TIMESTAMP', 'DATE', 'TIME', 'QINTEGER', 'QFLOAT', 'QBOOLEAN'])
+
+# quoted values are loaded as the type they look like
+quoted_types = {'QINTEGER': 'INTEGER', 'QFLOAT': 'FLOAT', 'QBOOLEAN': 'BOOLEAN'}
+
+# types which can be read out of a JSON string by BigQuery
+timestamp_re = re.compile(
+    r'^\d{4}-\d{1,2}-\d{1,2}[T ]\d{1,2}:\d{1,2}(:\d{1,2})?(\.\d{1,6})?'
+    r' *(([+-]\d{1,2}(:\d{1,2})?)|Z|UTC)?$')
+date_re = re.compile(r'^\d{4}-\d{1,2}-\d{1,2}$')
+time_re = re.compile(r'^\d{1,2}:\d{1,2}(:\d{1,2})?(\.\d{1,6})?$')
+integer_re = re.compile(r'^[-+]?\d+$')
+float_re = re.compile(r'^[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?$')
+
+INTEGER_MIN = -2 ** 63
+INTEGER_MAX = 2 ** 63 - 1
+
+# placeholder types for values that don't tell us anything yet, or that
+# need looking into, like bigquery_schema_generator's
+NULL = '__null__'
+EMPTY_RECORD = '__empty_record__'
+EMPTY_ARRAY = '__empty_array__'
+ARRAY = '__array__'
+
+
+def infer_type(value, quoted_values_are_strings=False):
+    """
+    Returns the BigQuery type of a single JSON value, or one of the
+    placeholder types above. Like bq load, strings that look like integers,
+    floats or booleans are typed as those, unless quoted_values_are_strings
+    is set. Integers too big for INT64 are FLOATs.
+    """
+    if value is None:
+        return NULL
+    if isinstance(value, bool):
+        return 'BOOLEAN'
+    if isinstance(value, int):
+        return 'INTEGER' if INTEGER_MIN <= value <= INTEGER_MAX else 'FLOAT'
+    if isinstance(value, float):
+        return 'FLOAT'
+    if isinstance(value, str):
+        if timestamp_re.match(value):
+            return 'TIMESTAMP'
+        if date_re.match(value):
+            return 'DATE'
+        if time_re.match(value):
+            return 'TIME'
+        if quoted_values_are_strings:
+            return 'STRING'
+        if integer_re.match(value):
+            return 'QINTEGER' if INTEGER_MIN <= int(value) <= INTEGER_MAX else 'QFLOAT'
+        if float_re.match(value):
+            return 'QFLOAT'
+        if value.lower() in ('true', 'false'):
+            return 'QBOOLEAN'
+        return 'STRING'
+    if isinstance(value, dict):
+        return 'RECORD' if value else EMPTY_RECORD
+    if isinstance(value, list):
+        return ARRAY if value else EMPTY_ARRAY
+    return 'STRING'
+
+
+def merge_types(old_type, new_type):
+    """
+    Returns the narrowest type that can hold both old_type and new_type, or
+    None if they conflict.
+    """
+    if old_type == new_type:
+        return old_type
+    merged = type_upgrades.get((old_type, new_type))
+    if merged is None and old_type in string_types and new_type in string_types:
+        return 'STRING'
+    return merged
+
+
+class SchemaBuilder:
+    """
+    Builds a BigQuery schema incrementally from records, in the same API
+    representation bigquery_schema_generator produces with --keep_nulls
+    (and --quoted_values_are_strings, if quoted_values_are_strings is set).
+    Like it, fields whose types conflict are left out of the schema, as are
+    arrays BigQuery can't load (nested, holding nulls or mixed types).
+    Only the schema is held in memory, never the records.
+    """
+    def __init__(self, quoted_values_are_strings=False):
+        self.fields = {}
+        self.row_count = 0
+        self.quoted_values_are_strings = quoted_values_are_strings
+
+    def add(self, record):
+        """
+        Folds a single dict record into the schema.
+        """
+        self._add_record(self.fields, record)
+        self.row_count += 1
+
+    def add_many(self, records):
+        for record in records:
+            self.add(record)
+        return self
+
+    def add_file(self, file_name):
+        """
+        Folds every line of a (optionally gzipped) NDJSON file into the
+        schema, one line at a time.
+        """
+        with open_ndjson(file_name) as f:
+            return self.add_lines(f)
+
+    def add_lines(self, lines):
+        """
+        Folds every line of an iterable of NDJSON lines into the schema.
+        """
+        for line in lines:
+            if line.strip():
+                self.add(json.loads(line))
+        return self
+
+    def schema(self):
+        """
+        Returns the schema as a list of API representation fields.
+        """
+        return self._to_api_repr(self.fields)
+
+    # Entries are dicts of name, type, mode, fields (of a RECORD) and status,
+    # which is 'soft' while only nulls and empty values have been seen,
+    # 'hard' once a real value has, and 'ignore' after a conflict. A field
+    # whose latest value couldn't be typed at all is None until the next one.
+
+    def _add_record(self, fields, record):
+        for key, value in record.items():
+            # BigQuery column names are case-insensitive
+            canonical_key = key.lower()
+            old = fields.get(canonical_key)
+            value_type = infer_type(value, self.quoted_values_are_strings)
+            # the common cases, another value of a column's type or of one
+            # we've given up on. arrays can still reset either, see _entry
+            if old is not None and value_type not in ('RECORD', ARRAY) and (
+                    old['status'] == 'ignore' or old['status'] == 'hard'
+                    and old['type'] == value_type and old['mode'] == 'NULLABLE'):
+                continue
+            fields[canonical_key] = self._merge(old, self._entry(key, value, value_type))
+
+    def _entry(self, key, value, value_type):
+        mode = 'NULLABLE'
+        if value_type == ARRAY:
+            mode = 'REPEATED'
+            value_type = self._array_type(value)
+            # only empty records can be repeated among the placeholder types
+            if value_type is None or value_type.startswith('__') and value_type != EMPTY_RECORD:
+                return None
+
+        if value_type == 'RECORD':
+            fields = {}
+            for item in (value if mode == 'REPEATED' else [value]):
+                self._add_record(fields, item)
+            return {'name': key, 'type': 'RECORD', 'mode': mode, 'fields': fields, 'status': 'hard'}
+        if value_type == NULL:
+            return {'name': key, 'type': 'STRING', 'mode': 'NULLABLE', 'fields': None, 'status': 'soft'}
+        if value_type == EMPTY_ARRAY:
+            return {'name': key, 'type': 'STRING', 'mode': 'REPEATED', 'fields': None, 'status': 'soft'}
+        if value_type == EMPTY_RECORD:
+            return {'name': key, 'type': 'RECORD', 'mode': mode, 'fields': {}, 'status': 'soft'}
+        return {'name': key, 'type': value_type, 'mode': mode, 'fields': None, 'status': 'hard'}
+
+    def _array_type(self, items):
+        array_type = None
+        for item in items:
+            item_type = infer_type(item, self.quoted_values_are_strings)
+            array_type = item_type if array_type is None else merge_types(array_type, item_type)
+            if array_type is None:
+                return None
+        return array_type
+
+    def _merge(self, old, new):
+        if old is None or new is None or new['status'] == 'ignore':
+            return new
+        if old['status'] == 'ignore':
+            return old
+
+        # a real value replaces a null or empty one, but keeps the mode rules
+        if old['status'] != new['status']:
+            mode = self._merge_mode(old, new)
+            if mode is None:
+                old['status'] = 'ignore'
+                return old
+            if old['status'] == 'hard':
+                old['mode'] = mode
+                return old
+            new['mode'] = mode
+            return new
+
+        new['name'] = old['name']
+        if old['type'] == 'RECORD' and new['type'] == 'RECORD':
+            # bq load allows a NULLABLE RECORD to become REPEATED
+            if new['mode'] == 'REPEATED':
+                old['mode'] = 'REPEATED'
+            for key, entry in new['fields'].items():
+                old['fields'][key] = self._merge(old['fields'].get(key), entry)
+            return old
+
+        mode = self._merge_mode(old, new)
+        field_type = merge_types(old['type'], new['type'])
+        if mode is None or field_type is None:
+            old['status'] = 'ignore'
+            return old
+        new['mode'] = mode
+        new['type'] = field_type
+        return new
+
+    def _merge_mode(self, old, new):
+        if old['mode'] == new['mode']:
+            return old['mode']
+        # only a null or empty value can change its mind about being an array
+        if old['mode'] == 'NULLABLE' and old['status'] == 'soft' and new['status'] == 'hard':
+            return new['mode']
+        if old['mode'] == 'REPEATED' and old['status'] == 'hard' and new['status'] == 'soft':
+            return old['mode']
+        return None
+
+    def _to_api_repr(self, fields):
+        schema = []
+        for key in sorted(fields):
+            entry = fields[key]
+            if entry is None or entry['status'] == 'ignore':
+                continue
+            field_type = quoted_types.get(entry['type'], entry['type'])
+            col = {'mode': entry['mode'], 'name': entry['name'], 'type': field_type}
+            if field_type == 'RECORD':
+                # BigQuery won't take a RECORD without fields
+                col['fields'] = (self._to_api_repr(entry['fields']) if entry['fields'] else
+                                 [{'mode': 'NULLABLE', 'name': '__unknown__', 'type': 'STRING'}])
+            schema.append(col)
+        return schema
+
+
+def generate_schema(file_name):
+    """
+    Returns the schema of an NDJSON file in a single streaming pass.
+    """
+    return SchemaBuilder().add_file(file_name).schema()
+
+
+def merge_schemas(old_schm, new_schm):
+    """
+    Adds any fields in new_schm that aren't in old_schm to old_schm, at every
+    level of nesting. Fields are matched by name through a dict, so this is
+    linear in the number of fields.
+    """
+    new_cols = {}
+    for col in new_schm:
+        if type(col) == dict:
+            new_cols.setdefault(col['name'], col)
+
+    old_names = {col['name'] for col in old_schm}
+    for name, col in new_cols.items():
+        if name not in old_names:
+            old_schm.append(col)
+            old_names.add(name)
+
+    for old_col in old_schm:
+        new_col = new_cols.get(old_col['name'])
+        # columns we just appended have nothing left to merge
+        if new_col is None or new_col is old_col:
+            continue
+        for meta in old_col:
+            if type(old_col[meta]) == list and meta in new_col:
+                old_col[meta] = merge_schemas(old_col[meta], new_col[meta])
+
+    return old_schm
@@ -0,0 +1,241 @@
+import datetime
+import decimal
+import json
+import logging
+import os
+import threading
+
+from popelines.lazy import lazy_import
+
+bigquery = lazy_import('google.cloud.bigquery')
+exceptions = lazy_import('google.api_core.exceptions')
+
+
+def coerce_watermark(value):
+    """
+    Turns ISO date and timestamp strings into dates and datetimes, so that
+    watermarks read out of JSON compare the same way BigQuery's do.
+    """
+    if not isinstance(value, str):
+        return value
+    text = value.strip()
+    if text.endswith('Z'):
+        text = text[:-1] + '+00:00'
+    elif text.endswith(' UTC'):
+        text = text[:-4] + '+00:00'
+    try:
+        if len(text) == 10:
+            return datetime.date.fromisoformat(text)
+        return datetime.datetime.fromisoformat(text)
+    except ValueError:
+        return value
+
+
+def _datetime(value):
+    # dates compare as midnight, so a column can mix dates and timestamps
+    if isinstance(value, datetime.date) and not isinstance(value, datetime.datetime):
+        return datetime.datetime.combine(value, datetime.time())
+    return value
+
+
+def _utc(value):
+    if isinstance(value, datetime.datetime) and value.tzinfo is None:
+        return value.replace(tzinfo=datetime.timezone.utc)
+    return value
+
+
+def later(a, b):
+    """
+    Returns whichever of a and b is later, comparing dates as midnight and
+    treating naive datetimes as UTC when they have to be compared with aware
+    ones. None counts as earliest. Raises TypeError if a and b can't be
+    compared, e.g. a string and a datetime.
+    """
+    if a is None:
+        return b
+    if b is None:
+        return a
+    x, y = _datetime(a), _datetime(b)
+    try:
+        return b if y > x else a
+    except TypeError:
+        return b if _utc(y) > _utc(x) else a
+
+
+def encode_watermark(value):
+    if isinstance(value, datetime.datetime):
+        return {'type': 'datetime', 'value': value.isoformat()}
+    if isinstance(value, datetime.date):
+        return {'type': 'date', 'value': value.isoformat()}
+    if isinstance(value, decimal.Decimal):
+        return {'type': 'decimal', 'value': str(value)}
+    return {'type': 'value', 'value': value}
+
+
+def decode_watermark(encoded):
+    if encoded['type'] == 'datetime':
+        return datetime.datetime.fromisoformat(encoded['value'])
+    if encoded['type'] == 'date':
+        return datetime.date.fromisoformat(encoded['value'])
+    if encoded['type'] == 'decimal':
+        return decimal.Decimal(encoded['value'])
+    return encoded['value']
+
+
+class WatermarkTracker:
+    """
+    Keeps the maximum value of each of columns over the records it observes.
+    Columns can be dotted paths into nested records. Values that can't be
+    compared with the rest of their column, like '' among timestamps, are
+    skipped and counted in skipped, rather than stopping the write.
+    """
+    def __init__(self, columns, log=None):
+        self.columns = list(columns)
+        self.values = {}
+        self.skipped = {}
+        self.log = log or logging.getLogger()
+
+    def observe(self, record):
+        for column in self.columns:
+            value = record
+            for key in column.split('.'):
+                value = value.get(key) if isinstance(value, dict) else None
+            if value is None:
+                continue
+            if isinstance(value, (dict, list)):
+                self._skip(column, value)
+                continue
+            value = coerce_watermark(value)
+            current = self.values.get(column)
+            try:
+                self.values[column] = later(current, value)
+            except TypeError:
+                # a string that didn't parse loses to a date, timestamp or number
+                if isinstance(current, str) and not isinstance(value, str):
+                    self.values[column] = value
+                    self._skip(column, current)
+                else:
+                    self._skip(column, value)
+
+    def _skip(self, column, value):
+        self.skipped[column] = self.skipped.get(column, 0) + 1
+        # log the first one only, a bad column can have millions
+        if self.skipped[column] == 1:
+            self.log.warning(f'Skipping watermark value {value!r} of {column}, which can\'t be '
+                             f'compared with its other values')
+
+
+class LocalWatermarkStore:
+    """
+    Keeps watermarks in a local JSON file.
+    """
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self.lock = threading.Lock()
+
+    def _read(self):
+        if not os.path.exists(self.file_name):
+            return {}
+        with open(self.file_name, 'r') as f:
+            return json.load(f)
+
+    def get(self, key):
+        with self.lock:
+            encoded = self._read().get(key)
+        return decode_watermark(encoded) if encoded else None
+
+    def _write(self, watermarks):
+        # write to a temp file first so a crash can't leave half a file
+        temp_name = f'{self.file_name}.tmp'
+        with open(temp_name, 'w') as f:
+            json.dump(watermarks, f, indent=2)
+        os.replace(temp_name, self.file_name)
+
+    def set(self, key, value):
+        with self.lock:
+            watermarks = self._read()
+            watermarks[key] = encode_watermark(value)
+            self._write(watermarks)
+
+    def clear(self, prefix, keep=()):
+        """
+        Forgets every watermark whose key starts with prefix, except keep.
+        """
+        with self.lock:
+            watermarks = self._read()
+            stale = [key for key in watermarks if key.startswith(prefix) and key not in keep]
+            if stale:
+                for key in stale:
+                    del watermarks[key]
+                self._write(watermarks)
+
+
+class TableWatermarkStore:
+    """
+    Keeps watermarks in a small BigQuery table, created on first use, so that
+    jobs running on different machines share them. The keys in the table are
+    read once and then kept up to date locally, so clear only runs a DELETE
+    when there is something to forget.
+    """
+    def __init__(self, bq_client, table_id):
+        self.bq_client = bq_client
+        self.table_id = table_id
+        self.created = False
+        self.keys = None
+        self.lock = threading.Lock()
+
+    def _keys(self):
+        if self.keys is None:
+            try:
+                rows = self.bq_client.query(f"SELECT key FROM `{self.table_id}`").result()
+                self.keys = {row[0] for row in rows}
+            except exceptions.NotFound:
+                self.keys = set()
+        return self.keys
+
+    def _create(self):
+        if not self.created:
+            self.bq_client.query(
+                f"CREATE TABLE IF NOT EXISTS `{self.table_id}` "
+                f"(key STRING, value STRING, updated_at TIMESTAMP)").result()
+            self.created = True
+
+    def get(self, key):
+        self._create()
+        query = f"SELECT value FROM `{self.table_id}` WHERE key = @key"
+        rows = list(self.bq_client.query(query, job_config=self._params(key=key)).result())
+        return decode_watermark(json.loads(rows[0][0])) if rows else None
+
+    def set(self, key, value):
+        self._create()
+        query = (f"MERGE `{self.table_id}` t USING (SELECT @key AS key, @value AS value) s "
+                 f"ON t.key = s.key "
+                 f"WHEN MATCHED THEN UPDATE SET value = s.value, updated_at = CURRENT_TIMESTAMP() "
+                 f"WHEN NOT MATCHED THEN INSERT (key, value, updated_at) "
+                 f"VALUES (s.key, s.value, CURRENT_TIMESTAMP())")
+        params = self._params(key=key, value=json.dumps(encode_watermark(value)))
+        self.bq_client.query(query, job_config=params).result()
+        with self.lock:
+            if self.keys is not None:
+                self.keys.add(key)
+
+    def clear(self, prefix, keep=()):
+        """
+        Forgets every watermark whose key starts with prefix, except keep.
+        """
+        with self.lock:
+            stale = {key for key in self._keys() if key.startswith(prefix) and key not in keep}
+            if not stale:
+                return
+            self.keys -= stale
+        self._create()
+        query = (f"DELETE FROM `{self.table_id}` "
+                 f"WHERE STARTS_WITH(key, @prefix) AND key NOT IN UNNEST(@keep)")
+        job_config = self._params(prefix=prefix)
+        job_config.query_parameters = job_config.query_parameters + [
+            bigquery.ArrayQueryParameter('keep', 'STRING', list(keep))]
+        self.bq_client.query(query, job_config=job_config).result()
+
+    def _params(self, **params):
+        return bigquery.QueryJobConfig(query_parameters=[
+            bigquery.ScalarQueryParameter(name, 'STRING', value) for name, value in params.items()])
@@ -0,0 +1,169 @@
+import gzip
+import io
+import json
+import os
+
+GZIP_MAGIC = b'\x1f\x8b'
+
+
+def is_gzipped(file_name):
+    """
+    Checks the first bytes of file_name for the gzip magic number.
+    """
+    with open(file_name, 'rb') as f:
+        return f.read(2) == GZIP_MAGIC
+
+
+def open_ndjson(file_name):
+    """
+    Opens a plain or gzipped NDJSON file for reading as text.
+    """
+    if is_gzipped(file_name):
+        return gzip.open(file_name, 'rt')
+    return open(file_name, 'r')
+
+
+def wrap_ndjson(raw):
+    """
+    Wraps a seekable binary file object holding plain or gzipped NDJSON so
+    that it reads as text. The caller is responsible for closing raw.
+    """
+    magic = raw.read(2)
+    raw.seek(0)
+    if magic == GZIP_MAGIC:
+        raw = gzip.GzipFile(fileobj=raw, mode='rb')
+    return io.TextIOWrapper(raw)
+
+
+def rotated_file_name(file_name, part):
+    """
+    Returns the name of the given part of a rotated file. Part 0 is
+    file_name itself, so code that doesn't rotate sees no difference.
+    """
+    if part == 0:
+        return file_name
+    root, ext = os.path.splitext(file_name)
+    # keep both extensions of e.g. data.json.gz together
+    if ext == '.gz':
+        root, inner_ext = os.path.splitext(root)
+        ext = inner_ext + ext
+    return f'{root}_{part:05d}{ext}'
+
+
+class JsonWriter:
+    """
+    Writes records as line-delimited JSON through a large write buffer,
+    optionally gzipped, rotating to a new file once max_file_bytes
+    (uncompressed) or max_file_rows is reached. Only one record is held in
+    memory at a time. Appending to a rotated file carries on from its last
+    existing part, so earlier parts are never overwritten.
+    """
+    def __init__(self,
+                 file_name,
+                 mode='w',
+                 compress=False,
+                 max_file_bytes=None,
+                 max_file_rows=None,
+                 buffer_size=1024 * 1024,
+                 compresslevel=6):
+        self.file_name = file_name
+        self.mode = mode
+        self.compress = compress
+        self.max_file_bytes = max_file_bytes
+        self.max_file_rows = max_file_rows
+        self.buffer_size = buffer_size
+        self.compresslevel = compresslevel
+
+        self.file_names = []
+        self.row_count = 0
+        self.byte_count = 0
+        self._file = None
+        self._raw = None
+        self._file_rows = 0
+        self._file_bytes = 0
+        self._part = 0
+        self._open()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def write(self, record):
+        line = (json.dumps(record) + '\n').encode()
+
+        if self._is_full(len(line)):
+            self.close()
+            self._open()
+
+        self._file.write(line)
+        self._file_rows += 1
+        self._file_bytes += len(line)
+        self.row_count += 1
+        self.byte_count += len(line)
+
+    def close(self):
+        if self._file is None:
+            return
+        self._file.close()
+        if self._raw is not self._file:
+            self._raw.close()
+        self._file = self._raw = None
+
+    def _is_full(self, next_bytes):
+        # never rotate away from an empty file
+        if not self._file_rows:
+            return False
+        if self.max_file_rows and self._file_rows >= self.max_file_rows:
+            return True
+        if self.max_file_bytes and self._file_bytes + next_bytes > self.max_file_bytes:
+            return True
+        return False
+
+    def _rotates(self):
+        return bool(self.max_file_bytes or self.max_file_rows)
+
+    def _last_part(self):
+        """
+        Returns the number of the last existing part of file_name, with its
+        row and uncompressed byte counts, or part 0 if none exist yet.
+        """
+        part = 0
+        while os.path.exists(rotated_file_name(self.file_name, part + 1)):
+            part += 1
+        file_name = rotated_file_name(self.file_name, part)
+        rows = size = 0
+        if os.path.exists(file_name) and os.path.getsize(file_name):
+            with open_ndjson(file_name) as f:
+                for line in f:
+                    rows += 1
+                    size += len(line.encode())
+        return part, rows, size
+
+    def _open(self):
+        rows = size = 0
+        if self.file_names:
+            # only the first file can be appended to; rotated files start fresh
+            self._part += 1
+            mode = 'w'
+        else:
+            mode = self.mode
+            if mode.startswith('a') and self._rotates():
+                self._part, rows, size = self._last_part()
+                if (self.max_file_rows and rows >= self.max_file_rows
+                        or self.max_file_bytes and size >= self.max_file_bytes):
+                    self._part += 1
+                    mode = 'w'
+                    rows = size = 0
+        file_name = rotated_file_name(self.file_name, self._part)
+
+        self._raw = open(file_name, mode.replace('b', '') + 'b', buffering=self.buffer_size)
+        if self.compress:
+            self._file = gzip.GzipFile(fileobj=self._raw, mode='wb', compresslevel=self.compresslevel)
+        else:
+            self._file = self._raw
+
+        self.file_names.append(file_name)
+        self._file_rows = rows
+        self._file_bytes = size
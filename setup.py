@@ -13,7 +13,7 @@ setuptools.setup(name='popelines',
       author_email='daniel.francis@infusionsoft.com',
       license='MIT',
       zip_safe=False,
-      packages=setuptools.find_packages(),
+      packages=setuptools.find_packages(exclude=['benchmarks', 'benchmarks.*']),
       classifiers=[
             "Programming Language :: Python :: 3",
             "License :: OSI Approved :: MIT License",
@@ -21,6 +21,11 @@ setuptools.setup(name='popelines',
       install_requires=[
           "google-cloud-storage",
           "google-cloud-bigquery",
-          "bigquery_schema_generator"
-      ]  
+          "requests"
+      ],
+      extras_require={
+          "arrow": ["pyarrow"],
+          "parquet": ["pyarrow"],
+          "avro": ["fastavro"]
+      }
 )
\ No newline at end of file